@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Бенчмарк фаз log_analyzer на синтетическом логе в формате ui_short.
+
+    python benchmark.py --lines 1000000 --urls 20000 --gzip --output bench.json
+    python benchmark.py --lines 1000000 --urls 20000 --gzip --baseline bench.json
+
+Каждая фаза запускается в отдельном процессе, поэтому peak RSS относится
+только к ней. Фазы накопительные: parse включает чтение, aggregate - чтение
+и разбор; чистое время фазы - разность с предыдущей.
+"""
+
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import bisect
+import shutil
+import logging
+import argparse
+import tempfile
+import resource
+import platform
+import multiprocessing
+
+import log_analyzer
+
+LINE = ('{ip} -  - [{time} +0300] "{method} {url} HTTP/1.1" 200 {size} "-" "{agent}" "-" '
+        '"{request_id}" "{user}" {request_time:.3f}\n')
+URL_TEMPLATES = (
+    '/api/v2/banner/{id}',
+    '/api/v2/group/{id}/banners',
+    '/api/v2/internal/banner/{id}/info',
+    '/api/1/campaigns/?id={id}',
+    '/api/v2/group/{id}/statistic/sites/?date_type=day&date_from=2017-06-29&date_to=2017-06-29',
+    '/export/appinstall_raw/2017-06-{day:02d}/',
+)
+AGENTS = ('-', 'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5', 'python-requests/2.13.0', 'Configovod')
+PHASES = ('read', 'parse', 'aggregate', 'top', 'render')
+
+
+def generate_log(path, lines=None, urls=10000, seed=1, malformed=0.0, zipf=1.1, latency_mu=-2.0, latency_sigma=1.0,
+                 size=None):
+    """ Пишет в path (gzip, если путь оканчивается на .gz) lines строк ui_short
+        или, если задан size, строки до достижения size байт без сжатия.
+
+        Популярность urls различных URL распределена по Ципфу с показателем zipf,
+        $request_time - логнормально с параметрами latency_mu и latency_sigma,
+        доля malformed строк не разбирается парсером. При одинаковом seed
+        содержимое лога одинаково. Возвращает число строк и размер лога в байтах
+        без сжатия.
+    """
+    rnd = random.Random(seed)
+    pool = [rnd.choice(URL_TEMPLATES).format(id=rnd.randint(1, 10 ** 8), day=rnd.randint(1, 28))
+            for _ in range(urls)]
+    weights = [1.0 / (rank + 1) ** zipf for rank in range(urls)]
+    total = sum(weights)
+    cumulative = []
+    acc = 0.0
+    for weight in weights:
+        acc += weight / total
+        cumulative.append(acc)
+    written = i = 0
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wb') as log:
+        while (written < size) if size else (i < lines):
+            if rnd.random() < malformed:
+                line = 'malformed line {} {}\n'.format(i, rnd.random())
+            else:
+                line = LINE.format(
+                    ip='1.{}.{}.{}'.format(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)),
+                    time='29/Jun/2017:{:02d}:{:02d}:{:02d}'.format(i // 3600 % 24, i // 60 % 60, i % 60),
+                    method='GET' if rnd.random() < 0.9 else 'POST',
+                    url=pool[min(bisect.bisect_left(cumulative, rnd.random()), urls - 1)],
+                    size=rnd.randint(0, 30000), agent=rnd.choice(AGENTS),
+                    request_id='{}-{}-4709-{}'.format(1498697461 + i // 1000, rnd.randint(0, 2 ** 32), i),
+                    user=rnd.choice(('-', '712e90144abee9', '89f7f1be37d')),
+                    request_time=min(rnd.lognormvariate(latency_mu, latency_sigma), 600.0))
+            line = line.encode('utf-8')
+            written += len(line)
+            log.write(line)
+            i += 1
+    return i, written
+
+
+def run_phase(phase, log, workdir, aggregation):
+    """Выполняет фазу и возвращает число строк, секунды и peak RSS процесса в КБ."""
+    started = time.time()
+    lines = 0
+    if phase == 'read':
+        for _ in log_analyzer.read_log(log):
+            lines += 1
+    elif phase == 'parse':
+        for _ in log_analyzer.log_generator(log, log_analyzer.LogFormatParser(), error_threshold=None):
+            lines += 1
+    else:
+        stats = {}
+        analyzer = log_analyzer.LogAnalyzer(
+            log_analyzer.log_generator(log, log_analyzer.LogFormatParser(), error_threshold=None, stats=stats),
+            aggregation
+        )
+        analyzer.get_data()
+        lines = stats['lines']
+        if phase in ('top', 'render'):
+            data = analyzer.top(log_analyzer.config['REPORT_SIZE'])
+            if phase == 'render':
+                log_analyzer.report(data, os.path.join(workdir, 'reports', 'report.html'))
+    seconds = time.time() - started
+    return lines, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _phase_worker(args):
+    return run_phase(*args)
+
+
+def benchmark(log, size, workdir, aggregation='exact', phases=PHASES):
+    results = {}
+    for phase in phases:
+        # свежий процесс на каждую фазу, чтобы peak RSS не копился между фазами
+        pool = multiprocessing.Pool(1)
+        try:
+            lines, seconds, rss = pool.apply(_phase_worker, ((phase, log, workdir, aggregation),))
+        finally:
+            pool.close()
+            pool.join()
+        results[phase] = {'seconds': seconds, 'lines': lines,
+                          'lines_per_sec': lines / seconds if seconds else None,
+                          'mb_per_sec': size / 1048576.0 / seconds if seconds else None,
+                          'peak_rss_kb': rss}
+        logging.info('{}: {:.3f}s, {} lines'.format(phase, seconds, lines))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Фазы, которые стали медленнее базовых более чем на tolerance (доля)."""
+    regressions = {}
+    for phase, result in results.items():
+        base = baseline.get(phase)
+        if base and base['seconds'] and result['seconds'] > base['seconds'] * (1 + tolerance):
+            regressions[phase] = result['seconds'] / base['seconds'] - 1
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='log_analyzer benchmark')
+    arg_parser.add_argument('--lines', type=int, default=1000000)
+    arg_parser.add_argument('--size-mb', type=int, help='generate lines up to this uncompressed size instead')
+    arg_parser.add_argument('--urls', type=int, default=10000, help='distinct URLs')
+    arg_parser.add_argument('--malformed', type=float, default=0.001, help='share of malformed lines')
+    arg_parser.add_argument('--zipf', type=float, default=1.1, help='URL popularity skew')
+    arg_parser.add_argument('--latency-mu', type=float, default=-2.0)
+    arg_parser.add_argument('--latency-sigma', type=float, default=1.0)
+    arg_parser.add_argument('--seed', type=int, default=1)
+    arg_parser.add_argument('--gzip', action='store_true', help='benchmark a gzip log')
+    arg_parser.add_argument('--aggregation', default='exact', choices=sorted(log_analyzer.AGGREGATIONS))
+    arg_parser.add_argument('--phases', nargs='+', default=PHASES, choices=PHASES)
+    arg_parser.add_argument('--workdir', help='where to keep the generated log (default: temporary)')
+    arg_parser.add_argument('--output', help='write results as JSON')
+    arg_parser.add_argument('--baseline', help='JSON results to compare with')
+    arg_parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown against the baseline')
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format=log_analyzer.FORMAT[0], datefmt=log_analyzer.FORMAT[1])
+
+    workdir = args.workdir or tempfile.mkdtemp()
+    log_analyzer.config['REPORT_TEMPLATE'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'report.html')
+    params = {'lines': args.lines, 'size_mb': args.size_mb, 'urls': args.urls, 'malformed': args.malformed,
+              'zipf': args.zipf, 'latency_mu': args.latency_mu, 'latency_sigma': args.latency_sigma,
+              'seed': args.seed, 'gzip': args.gzip, 'aggregation': args.aggregation}
+    try:
+        log = os.path.join(workdir, 'nginx-access-ui.log-{seed}-{urls}{ext}'.format(
+            ext='.gz' if args.gzip else '.log', **params))
+        logging.info('Generating {}'.format(log))
+        lines, size = generate_log(log, args.lines, args.urls, args.seed, args.malformed, args.zipf,
+                                   args.latency_mu, args.latency_sigma, args.size_mb and args.size_mb * 1048576)
+        results = benchmark(log, size, workdir, args.aggregation, args.phases)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+    output = {'params': params, 'generated_lines': lines, 'size': size, 'python': platform.python_version(),
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2, sort_keys=True)
+    print(json.dumps(output, indent=2, sort_keys=True))
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file)['results'], args.tolerance)
+        for phase, slowdown in sorted(regressions.items()):
+            logging.error('{} is {:.0%} slower than the baseline'.format(phase, slowdown))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
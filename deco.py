@@ -1,8 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import time
+import threading
+import itertools
+from collections import deque
+from collections import namedtuple
+from collections import OrderedDict
 from functools import update_wrapper
 
+CacheInfo = namedtuple('CacheInfo', 'hits misses evictions maxsize currsize')
+
 
 def disable(func):
     '''
@@ -38,22 +46,120 @@ def countcalls(func):
     return countwrapper
 
 
-def memo(func):
+def memo(func=None, maxsize=None):
     '''
-    Memoize a function so that it caches all return values for
-    faster future lookups.
+    Memoize a function so that it caches return values for
+    faster future lookups. With maxsize only the maxsize least
+    recently used results are kept:
+
+    @memo(maxsize=1024)
+    def normalize(url):
+        ....
+
+    memowrapper.cache_info() returns hits, misses and evictions,
+    memowrapper.cache_clear() empties the cache. The cache is
+    guarded by a lock, but the function itself is called outside
+    of it, so two threads may compute the same value at once.
+    Calls with unhashable arguments are not cached.
     '''
-    results = {}
+    if func is None:
+        return lambda func: memo(func, maxsize)
+    results = OrderedDict() if maxsize else {}
+    lock = threading.Lock()
+    missing = object()
+    stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
     def memowrapper(*args):
-        if not args in results:
-            results[args] = func(*args)
-            if hasattr(func, 'calls'):
-                setattr(memowrapper, 'calls', func.calls)
-        return results[args]
+        try:
+            with lock:
+                res = results.pop(args, missing) if maxsize else results.get(args, missing)
+                if res is not missing:
+                    if maxsize:
+                        # re-inserted key becomes the most recently used
+                        results[args] = res
+                    stats['hits'] += 1
+                    return res
+                stats['misses'] += 1
+        except TypeError:
+            with lock:
+                stats['misses'] += 1
+            return func(*args)
+        res = func(*args)
+        if hasattr(func, 'calls'):
+            setattr(memowrapper, 'calls', func.calls)
+        with lock:
+            results[args] = res
+            if maxsize and len(results) > maxsize:
+                results.popitem(last=False)
+                stats['evictions'] += 1
+        return res
+
+    def cache_info():
+        with lock:
+            return CacheInfo(stats['hits'], stats['misses'], stats['evictions'], maxsize, len(results))
+
+    def cache_clear():
+        with lock:
+            results.clear()
+            stats.update(hits=0, misses=0, evictions=0)
+
     update_wrapper(memowrapper, func)
+    memowrapper.cache_info = cache_info
+    memowrapper.cache_clear = cache_clear
     return memowrapper
 
 
+def timed(func):
+    '''
+    Decorator that counts calls made to the function decorated
+    and collects their latencies into a histogram of power-of-two
+    buckets: timedwrapper.histogram[i] is the number of calls that
+    took less than 2 ** i microseconds (and at least half of it).
+    Per call it costs two clock reads and a lock.
+
+    timedwrapper.stats() returns a dict with the number of calls,
+    their total and maximum time and the p50 and p99 latencies in
+    seconds. Percentiles are the upper bounds of their buckets.
+    '''
+    lock = threading.Lock()
+
+    def timedwrapper(*args, **kwargs):
+        started = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.time() - started
+            bucket = min(int(elapsed * 1000000).bit_length(), 63)
+            with lock:
+                timedwrapper.calls += 1
+                timedwrapper.total += elapsed
+                timedwrapper.histogram[bucket] += 1
+                if elapsed > timedwrapper.max:
+                    timedwrapper.max = elapsed
+
+    def percentile(q):
+        rank = q * timedwrapper.calls
+        seen = 0
+        for bucket, count in enumerate(timedwrapper.histogram):
+            seen += count
+            if count and seen >= rank:
+                return (1 << bucket) / 1000000.0
+        return 0.0
+
+    def stats():
+        with lock:
+            return {'calls': timedwrapper.calls, 'total': timedwrapper.total, 'max': timedwrapper.max,
+                    'p50': percentile(0.5), 'p99': percentile(0.99)}
+
+    update_wrapper(timedwrapper, func)
+    timedwrapper.calls = 0
+    timedwrapper.total = 0.0
+    timedwrapper.max = 0.0
+    timedwrapper.histogram = [0] * 64
+    timedwrapper.stats = stats
+    return timedwrapper
+
+
 def n_ary(func):
     '''
     Given binary function f(x, y), return an n_ary function such
@@ -110,6 +216,45 @@ def trace(s):
         return tracewrapper
     return deco
 
+
+def sampled(n, keep=100, log=None):
+    '''Sampling variant of trace for hot loops: records only
+    every n-th call made to function decorated.
+
+    @sampled(1000, log=logging.info)
+    def parse(line):
+        ....
+
+    A record (args, result, seconds) goes to samplewrapper.samples,
+    which keeps the last keep records, and to log if it is given.
+    Other calls cost one counter increment. Exceptions are recorded
+    as results of sampled calls and re-raised.
+    '''
+    def deco(func):
+        counter = itertools.count(1)
+
+        def samplewrapper(*args):
+            if next(counter) % n:
+                return func(*args)
+            started = time.time()
+            res = None
+            try:
+                res = func(*args)
+                return res
+            except Exception as exc:
+                res = exc
+                raise
+            finally:
+                record = (args, res, time.time() - started)
+                samplewrapper.samples.append(record)
+                if log:
+                    log('{}({}) == {!r} in {:.6f}s'.format(func.__name__, ', '.join(map(repr, args)),
+                                                          record[1], record[2]))
+        update_wrapper(samplewrapper, func)
+        samplewrapper.samples = deque(maxlen=keep)
+        return samplewrapper
+    return deco
+
 @memo
 @countcalls
 @n_ary
@@ -131,6 +276,17 @@ def fib(n):
     """Some doc"""
     return 1 if n <= 1 else fib(n-1) + fib(n-2)
 
+
+@timed
+@memo(maxsize=2)
+def square(n):
+    return n * n
+
+
+@sampled(3)
+def half(n):
+    return n / 2.0
+
 def main():
     print foo(4, 3)
     print foo(4, 3, 2)
@@ -146,6 +302,15 @@ def main():
     fib(3)
     print fib.calls, 'calls made'
 
+    for n in (1, 2, 1, 3, 2, 1):
+        square(n)
+    print square.cache_info()
+    print "square was called", square.stats()['calls'], "times"
+
+    for n in range(10):
+        half(n)
+    print "half was sampled", list(half.samples)
+
 
 if __name__ == '__main__':
     main()
@@ -6,14 +6,48 @@ import os
 import re
 import sys
 import time
-import gzip
+import io
 import json
+import gzip
+import socket
+import hashlib
+import math
+import heapq
+import bisect
+import random
+import array
+import zlib
+import mmap
+import shutil
+import tempfile
+import signal
 import logging
 import argparse
+import operator
+import itertools
+import threading
+import subprocess
+import multiprocessing
 import traceback
+import contextlib
 from datetime import datetime
 from collections import namedtuple
 from collections import defaultdict
+try:
+    from Queue import Queue, Full, Empty
+except ImportError:
+    from queue import Queue, Full, Empty
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # log_format ui_short '$remote_addr $remote_user $http_x_real_ip [$time_local] "$request" '
 #                     '$status $body_bytes_sent "$http_referer" '
@@ -27,35 +61,418 @@ config = {
 }
 
 CONFIG = 'log_analyzer.conf'
+LOG_FORMAT = ('$remote_addr $remote_user $http_x_real_ip [$time_local] "$request" '
+              '$status $body_bytes_sent "$http_referer" '
+              '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
+              '$request_time')
 RE_LOG_LINE = r"^.+(?:(?:GET)|(?:POST)|(?:HEAD)|(?:PUT)) (?P<url>.*) HTTP/1\.[01].+(?P<request_time>\d+\.\d{3})$"
+RE_LOG_VAR = r"\$(\w+)"
+RE_REQUEST = r"(?P<method>[A-Z]+) (?P<url>\S*) (?P<protocol>HTTP/1\.[01])"
+RE_REQUEST_TIME = r"\d+\.\d{3}"
+RE_URL_HEX = r"^[0-9a-fA-F]{8,}$"
+RE_URL_UUID = r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$"
+RE_AGGREGATE_NAME = r"^aggregate-(?P<date>\d{4}\.\d{2}\.\d{2})\.json\.gz$"
 RE_LOG_NAME = r"^nginx-access-ui\.log-(?P<date>\d{8})(?:\.(?:(?:gz)|(?:log)|(?:txt)))?$"
 PLACEHOLDER = '$table_json'
+PAGES_PLACEHOLDER = '$table_pages'
+SERIES_PLACEHOLDER = '$table_series'
 FORMAT = ('[%(asctime)s] %(levelname).1s %(message)s', '%Y.%m.%d %H:%M:%S')
+PY3 = sys.version_info[0] == 3
+intern = getattr(sys, 'intern', None) or intern
 
+if PY3:
+    def decode_line(line):
+        return line.decode('utf-8', 'surrogateescape')
 
-def log_generator(log, parser=None, re_log_str=None, error_threshold=0.4):
-    """ Генератор, обеспечивающий построковое чтение лог-файла.
-        В качестве аргументов можно передать парсер, строку регулярного выражения
-        и порог ошибок парсинга.
+    def line_size(line):
+        return len(line.encode('utf-8', 'surrogateescape'))
+
+    array_to_bytes = array.array.tobytes
+    array_from_bytes = array.array.frombytes
+else:
+    line_size = len
+    array_to_bytes = array.array.tostring
+    array_from_bytes = array.array.fromstring
+GZIP_BLOCK_SIZE = 1 << 20
+GZIP_QUEUE_SIZE = 8
+GZIP_COMMANDS = ('pigz', 'gzip')
+CHECKPOINT_VERSION = 2
+CHECKPOINT_EVERY = 1000000
+PROGRESS_EVERY = 1000000
+# в метриках запуска замеряется каждый TIMING_EVERY-й элемент потока строк (см. timed_items)
+TIMING_EVERY = 64
+FINGERPRINT_SIZE = 1024
+# максимум декодированных URL в кэше разбора plain-лога по mmap (два поколения по половине)
+URL_CACHE_SIZE = 65536
+# максимум разобранных значений $request_time в кэше LogAnalyzer
+TIME_CACHE_SIZE = 16384
+AGGREGATE_VERSION = 1
+SAMPLE_RATE = 0.01
+SAMPLE_BLOCK_SIZE = 1 << 16
+SAMPLE_ERROR_CHECK = 1000
+FOLLOW_INTERVAL = 30
+FOLLOW_POLL = 1.0
+FOLLOW_BLOCK_SIZE = 1 << 20
+SERIES_BUDGET = 200000
+# верхние границы корзин гистограммы $request_time в ячейке ряда, последняя корзина - больше 10 секунд
+SERIES_BOUNDS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MONTHS = dict((name, i + 1) for i, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')))
+SPILL_PARTITIONS = 16
+SPILL_CHECK_EVERY = 10000
+# грубая оценка байт на ключ (строка, словарь, запись) и на значение в записи по режимам агрегации
+SPILL_KEY_BYTES = {'exact': 200, 'compact': 200, 'sketch': 600}
+SPILL_VALUE_BYTES = {'exact': 32, 'compact': 4, 'sketch': 0}
+# квантиль нормального распределения для 95% доверительных интервалов
+CONFIDENCE_Z = 1.96
+
+
+def which(name):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(path, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def gzip_finished(decompressor):
+    if hasattr(decompressor, 'eof'):
+        return decompressor.eof
+    # в python 2 конец потока виден только по тому, что лишний байт попал в unused_data
+    try:
+        decompressor.decompress(b'\x00')
+    except zlib.error:
+        return False
+    return decompressor.unused_data == b'\x00'
+
+
+def gzip_blocks(log, method='auto', block_size=GZIP_BLOCK_SIZE):
+    """ Генератор распакованных блоков gzip-лога.
+        method: 'auto' - внешний pigz или gzip, если есть, иначе zlib; имя команды;
+        'zlib' - распаковка в текущем процессе (поддерживаются многотомные gzip).
     """
-    error_threshold = error_threshold
-    _all = 0
-    errors = 0
-    with gzip.open(log) if log.endswith('.gz') else open(log) as log_file:
-        for line in log_file:
-            if line:
-                if parser and re_log_str:
-                    _all += 1
-                    line = parser(re_log_str, line)
-                    if not line:
-                        errors += 1
+    command = None
+    if method == 'auto':
+        command = next((path for path in map(which, GZIP_COMMANDS) if path), None)
+    elif method != 'zlib':
+        command = which(method)
+        if not command:
+            raise IOError('Decompressor {} not found'.format(method))
+    if command:
+        process = subprocess.Popen([command, '-dc', log], stdout=subprocess.PIPE, bufsize=block_size)
+        try:
+            for block in iter(lambda: process.stdout.read(block_size), b''):
+                yield block
+        finally:
+            killed = process.poll() is None
+            if killed:
+                process.kill()
+            process.stdout.close()
+            if process.wait() and not killed:
+                raise IOError('{} failed to decompress {}'.format(command, log))
+        return
+    with open(log, 'rb') as log_file:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        started = False
+        for chunk in iter(lambda: log_file.read(block_size), b''):
+            started = True
+            while chunk:
+                if decompressor is None:
+                    # за gzip-членом могут идти нулевые байты дополнения: gzip и gzip.open их пропускают
+                    chunk = chunk.lstrip(b'\x00')
+                    if not chunk:
+                        break
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                block = decompressor.decompress(chunk)
+                if block:
+                    yield block
+                # остаток относится к следующему gzip-члену файла
+                chunk = decompressor.unused_data
+                if chunk:
+                    decompressor = None
+        if started and decompressor is not None and not gzip_finished(decompressor):
+            raise IOError('Compressed file ended before the end-of-stream marker was reached')
+
+
+def split_lines(data):
+    """Делит блок целых строк на строки только по переводу строки, сохраняя его."""
+    if PY3:
+        return io.StringIO(decode_line(data), newline='\n').readlines()
+    return io.BytesIO(data).readlines()
+
+
+def thread_cpu_time():
+    """Процессорное время текущего потока или None, если его не узнать (Python 2)."""
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+    if resource is not None and hasattr(resource, 'RUSAGE_THREAD'):
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    return None
+
+
+def _gzip_producer(log, method, block_size, batches, stop, timing):
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    # время ожидания блоков распаковки и CPU потока (распаковка zlib и деление
+    # на строки) и внешнего pigz/gzip, который завершается внутри gzip_blocks
+    clock = time.time
+    thread_cpu, child_cpu = thread_cpu_time(), sum(os.times()[2:4])
+    wall = 0.0
+    tail = b''
+    try:
+        blocks = gzip_blocks(log, method, block_size)
+        try:
+            while True:
+                started = clock()
+                block = next(blocks, None)
+                wall += clock() - started
+                if block is None:
+                    break
+                block = tail + block
+                cut = block.rfind(b'\n') + 1
+                tail = block[cut:]
+                if cut and not put(split_lines(block[:cut])):
+                    return
+        finally:
+            blocks.close()
+            timing.update(decompress_wall=wall, decompress_child_cpu=sum(os.times()[2:4]) - child_cpu,
+                          decompress_cpu=thread_cpu_time() - thread_cpu if thread_cpu is not None else None)
+        if tail:
+            put(split_lines(tail))
+        put(None)
+    except Exception as e:
+        put(e)
+
+
+def read_gzip(log, method='auto', block_size=GZIP_BLOCK_SIZE, queue_size=GZIP_QUEUE_SIZE, stats=None):
+    """ Построчное чтение gzip-лога с распаковкой в отдельном потоке
+        (или во внешнем процессе pigz/gzip, см. gzip_blocks). Строки передаются
+        пачками через очередь из queue_size пачек, поэтому память ограничена
+        примерно queue_size * block_size независимо от размера лога.
+    """
+    for batch in gzip_batches(log, method, block_size, queue_size, stats):
+        for line in batch:
+            yield line
+
+
+def gzip_batches(log, method='auto', block_size=GZIP_BLOCK_SIZE, queue_size=GZIP_QUEUE_SIZE, stats=None):
+    """ Пачки строк gzip-лога в порядке файла (см. read_gzip); каждая строка попадает
+        ровно в одну пачку. По окончании в stats пишутся decompress_wall (ожидание
+        блоков распаковки), decompress_cpu (CPU потока распаковки, None в Python 2)
+        и decompress_child_cpu (CPU внешнего pigz/gzip).
+    """
+    batches = Queue(queue_size)
+    stop = threading.Event()
+    timing = {}
+    producer = threading.Thread(target=_gzip_producer, args=(log, method, block_size, batches, stop, timing))
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        stop.set()
+        producer.join()
+        if stats is not None:
+            stats.update(timing)
+
+
+def read_log(log, start=0, end=None, stats=None):
+    """ Построчное чтение лога с позиции start (начало строки). Для plain-логов
+        можно задать конец диапазона байт end: чтение заканчивается на первой
+        строке, начинающейся не раньше end. В gzip-логе позиция считается
+        в распакованных байтах, и строки до неё пропускаются без разбора;
+        в stats пишется время распаковки (см. gzip_batches).
+    """
+    if log.endswith('.gz'):
+        if end is not None:
+            raise ValueError('Byte ranges are not supported for gzip logs')
+        offset = 0
+        for line in read_gzip(log, config.get('GZIP_DECOMPRESSOR', 'auto'), stats=stats):
+            if offset >= start:
                 yield line
+            else:
+                offset += line_size(line)
+        return
+    with open(log, 'rb') as log_file:
+        log_file.seek(start)
+        offset = start
+        for line in log_file:
+            if end is not None:
+                if offset >= end:
+                    break
+                offset += len(line)
+            yield decode_line(line) if PY3 else line
+
+
+def line_start(log_file, offset):
+    """Начало первой строки, начинающейся не раньше offset."""
+    if offset <= 0:
+        return 0
+    # дочитываем строку, в которую попало смещение
+    log_file.seek(offset - 1)
+    log_file.readline()
+    return log_file.tell()
+
+
+def last_line_end(log, block_size=1 << 16):
+    """ Конец последней строки plain-лога, завершенной переводом строки (0, если
+        таких нет): недописанная строка в конце растущего лога ждет следующего разбора.
+    """
+    with open(log, 'rb') as log_file:
+        end = os.fstat(log_file.fileno()).st_size
+        while end > 0:
+            begin = max(end - block_size, 0)
+            log_file.seek(begin)
+            index = log_file.read(end - begin).rfind(b'\n')
+            if index >= 0:
+                return begin + index + 1
+            end = begin
+    return 0
+
+
+def split_log(log, parts, start=0, end=None):
+    """ Делит plain-лог с позиции start до end (по умолчанию до конца файла)
+        на parts диапазонов байт, выровненных по началам строк.
+    """
+    size = os.path.getsize(log) if end is None else end
+    bounds = [start]
+    with open(log, 'rb') as log_file:
+        for i in range(1, parts):
+            offset = max(start + (size - start) * i // parts, bounds[-1])
+            if 0 < offset < size:
+                offset = line_start(log_file, offset)
+            bounds.append(min(offset, size))
+    bounds.append(size)
+    return [(begin, end) for begin, end in zip(bounds, bounds[1:]) if begin < end]
+
+
+def check_errors(_all, errors, error_threshold):
     if _all * error_threshold < errors and (
             _all >= config['REPORT_SIZE']):
         # превышен порог ошибок парсинга
         logging.error('{} entries out of {} failed to parse'.format(errors, _all))
 
 
+def log_generator(log, parser=None, re_log_str=None, error_threshold=0.4, start=0, end=None, stats=None,
+                  on_progress=None, progress_every=PROGRESS_EVERY):
+    """ Генератор, обеспечивающий построковое чтение лог-файла.
+        В качестве аргументов можно передать парсер, строку регулярного выражения
+        и порог ошибок парсинга. Если строка регулярного выражения не задана,
+        парсер вызывается с одной строкой лога (см. LogFormatParser).
+        start и end задают диапазон байт лога (см. read_log). В словарь stats
+        записываются позиция в логе (offset), число разобранных строк и ошибок
+        парсинга: по окончании и перед вызовом on_progress(stats), который делается
+        каждые progress_every строк - к этому моменту все ранее выданные строки
+        уже обработаны потребителем. При error_threshold=None порог ошибок не проверяется.
+        plain-лог разбирается по отображенному в память файлу без декодирования
+        строк, если у парсера есть bytes_regex (см. LogFormatParser).
+    """
+    if (parser is not None and re_log_str is None and getattr(parser, 'bytes_regex', None)
+            and not log.endswith('.gz')):
+        return _mmap_log_generator(log, parser, error_threshold, start, end, stats, on_progress, progress_every)
+    return _text_log_generator(log, parser, re_log_str, error_threshold, start, end, stats, on_progress,
+                               progress_every)
+
+
+def _text_log_generator(log, parser, re_log_str, error_threshold, start, end, stats, on_progress, progress_every):
+    stats = {} if stats is None else stats
+    next_progress = progress_every if on_progress else None
+    _all = 0
+    errors = 0
+    offset = start
+    for line in read_log(log, start, end, stats):
+        if line:
+            if parser:
+                if _all == next_progress:
+                    stats.update(offset=offset, lines=_all, errors=errors)
+                    on_progress(stats)
+                    next_progress += progress_every
+                _all += 1
+                offset += line_size(line)
+                line = parser(re_log_str, line) if re_log_str else parser(line)
+                if not line:
+                    errors += 1
+            else:
+                offset += line_size(line)
+            yield line
+    stats.update(offset=offset, lines=_all, errors=errors)
+    if error_threshold is not None:
+        check_errors(_all, errors, error_threshold)
+
+
+def _mmap_log_generator(log, parser, error_threshold, start, end, stats, on_progress, progress_every):
+    """ Разбор plain-лога по mmap: границы строк и поля url и request_time
+        ищутся прямо в буфере регулярным выражением на bytes, декодированные
+        URL кэшируются. Кэш ограничен URL_CACHE_SIZE записями и вытесняет
+        давно не встречавшиеся URL, как в UrlNormalizer. Строки, не подошедшие
+        под bytes_regex, декодируются и отдаются самому парсеру. request_time
+        выдается как bytes.
+    """
+    stats = {} if stats is None else stats
+    next_progress = progress_every if on_progress else None
+    _all = 0
+    errors = 0
+    offset = start
+    with open(log, 'rb') as log_file:
+        size = os.fstat(log_file.fileno()).st_size
+        end = size if end is None else min(end, size)
+        # пустой файл отобразить нельзя
+        if offset < end:
+            buf = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                match = parser.bytes_regex.match
+                find = buf.find
+                urls = {}
+                old_urls = {}
+                while offset < end:
+                    line_end = find(b'\n', offset) + 1 or size
+                    if _all == next_progress:
+                        stats.update(offset=offset, lines=_all, errors=errors)
+                        on_progress(stats)
+                        next_progress += progress_every
+                    _all += 1
+                    found = match(buf, offset, line_end)
+                    if found:
+                        raw_url, request_time = found.groups()
+                        url = urls.get(raw_url)
+                        if url is None:
+                            url = old_urls.get(raw_url)
+                            if url is None:
+                                url = intern(decode_line(raw_url) if PY3 else raw_url)
+                            if len(urls) >= URL_CACHE_SIZE // 2:
+                                old_urls = urls
+                                urls = {}
+                            urls[raw_url] = url
+                        item = (url, request_time)
+                    else:
+                        line = buf[offset:line_end]
+                        item = parser(decode_line(line) if PY3 else line)
+                        if not item:
+                            errors += 1
+                    offset = line_end
+                    yield item
+            finally:
+                found = None
+                buf.close()
+    stats.update(offset=offset, lines=_all, errors=errors)
+    if error_threshold is not None:
+        check_errors(_all, errors, error_threshold)
+
+
 def log_parser(re_log_str, line):
     """Парсер логов"""
     re_log_line = re.compile(re_log_str)
@@ -66,22 +483,767 @@ def log_parser(re_log_str, line):
         return None
 
 
+class LogFormatParser(object):
+    """ Парсер, собираемый один раз по строке nginx log_format.
+
+        Формат компилируется в якорное регулярное выражение, а для типичного
+        случая ("$request" в кавычках, $request_time в конце строки) дополнительно
+        строится быстрый путь на find/rfind без регулярных выражений.
+        Строки, которые быстрый путь не разобрал, отдаются регулярному выражению.
+
+        fields - кортеж извлекаемых полей: имена переменных формата без '$',
+        а также method, url и protocol из $request. Результат - кортеж значений
+        в порядке fields, либо None, если строка не разобрана.
+    """
+
+    REQUEST_FIELDS = ('method', 'url', 'protocol')
+    FAST_FIELDS = REQUEST_FIELDS + ('request_time', 'time_local')
+
+    def __init__(self, log_format=LOG_FORMAT, fields=('url', 'request_time')):
+        self.log_format = log_format
+        self.fields = tuple(fields)
+        tokens = re.split(RE_LOG_VAR, log_format)
+        literals, variables = tokens[::2], tokens[1::2]
+        names = set(variables)
+        if 'request' in names:
+            names.update(self.REQUEST_FIELDS)
+        unknown = [field for field in self.fields if field not in names]
+        if unknown:
+            raise ValueError('Unknown log format fields: {}'.format(', '.join(unknown)))
+        self.regex = re.compile(self._compile_regex(literals, variables))
+        self._fast = self._compile_fast(literals, variables)
+        self.bytes_regex = None
+        if self._fast and self.fields == ('url', 'request_time'):
+            self.bytes_regex = self._compile_bytes(literals, variables)
+
+    @staticmethod
+    def _compile_regex(literals, variables):
+        parts = ['^']
+        for i, var in enumerate(variables):
+            before, after = literals[i], literals[i + 1]
+            parts.append(r' +'.join(re.escape(chunk) for chunk in re.split(r' +', before)))
+            if var == 'request':
+                parts.append(RE_REQUEST)
+                continue
+            elif var == 'request_time':
+                pattern = RE_REQUEST_TIME
+            elif before.endswith('"') and after.startswith('"'):
+                pattern = r'[^"]*'
+            elif before.endswith('[') and after.startswith(']'):
+                pattern = r'[^\]]*'
+            else:
+                pattern = r'\S*'
+            parts.append('(?P<{}>{})'.format(var, pattern))
+        parts.append(r' +'.join(re.escape(chunk) for chunk in re.split(r' +', literals[-1])))
+        parts.append(r'\s*$')
+        return ''.join(parts)
+
+    def _compile_fast(self, literals, variables):
+        """Возвращает индексы полей для быстрого пути или None, если он неприменим."""
+        if not set(self.fields) <= set(self.FAST_FIELDS):
+            return None
+        if variables[-1] != 'request_time' or literals[-1] or not literals[-2].endswith(' '):
+            return None
+        if 'request' not in variables:
+            return None
+        i = variables.index('request')
+        if not (literals[i].endswith('"') and literals[i + 1].startswith('"')):
+            return None
+        # в маркер попадает закрывающая скобка $time_local, если она стоит перед запросом
+        self._request_mark = literals[i].lstrip(' ') or '"'
+        self._time_mark = None
+        if 'time_local' in self.fields:
+            if 'time_local' not in variables:
+                return None
+            j = variables.index('time_local')
+            if j > i or not (literals[j].endswith('[') and literals[j + 1].startswith(']')):
+                return None
+            self._time_mark = '['
+        self._time_ok = re.compile(RE_REQUEST_TIME + '$').match
+        return operator.itemgetter(*[self.FAST_FIELDS.index(field) for field in self.fields])
+
+    def _compile_bytes(self, literals, variables):
+        """Регулярное выражение быстрого пути на bytes с группами url и request_time."""
+        mark = self._request_mark.encode('utf-8') if PY3 else self._request_mark
+        i = variables.index('request')
+        # если кавычек до "$request" в формате нет, до маркера можно дойти без поиска с возвратами
+        prefix = br'[^"]*' if '"' not in ''.join(literals[:i]) + literals[i][:-1] else b'.*?'
+        return re.compile(prefix + re.escape(mark) + br'[A-Z]+ (\S*) HTTP/1\.[01]".* (\d+\.\d{3})\s*$')
+
+    def parse_fast(self, line):
+        """Быстрый разбор строки без регулярного выражения по всей строке."""
+        start = line.find(self._request_mark)
+        if start < 0:
+            return None
+        start += len(self._request_mark)
+        end = line.find('"', start)
+        if end < 0:
+            return None
+        request = line[start:end].split(' ')
+        if len(request) != 3 or request[2] not in ('HTTP/1.0', 'HTTP/1.1') or not request[0].isupper():
+            return None
+        request_time = line[line.rfind(' ') + 1:].rstrip()
+        if not self._time_ok(request_time):
+            return None
+        time_local = None
+        if self._time_mark:
+            left = line.find(self._time_mark)
+            right = line.find(']', left)
+            if left < 0 or right < 0 or right > start:
+                return None
+            time_local = line[left + 1:right]
+        request.append(request_time)
+        request.append(time_local)
+        return request
+
+    def parse_regex(self, line):
+        """Разбор строки якорным регулярным выражением формата."""
+        match = self.regex.match(line)
+        if not match:
+            return None
+        return tuple(match.group(field) for field in self.fields)
+
+    def __call__(self, line):
+        if self._fast:
+            values = self.parse_fast(line)
+            if values is not None:
+                values = self._fast(values)
+                return values if len(self.fields) > 1 else (values,)
+        return self.parse_regex(line)
+
+
+class UrlNormalizer(object):
+    """ Приведение URL к шаблону, чтобы идентификаторы не плодили ключи отчета.
+
+        ids - заменять числовые, hex (от 8 символов) и UUID сегменты пути
+        на {id}, {hex} и {uuid}; query - что делать со строкой запроса:
+        keep - оставить, strip - отбросить, template - заменить значения на {};
+        rules - пары (регулярное выражение, замена), применяемые к URL до
+        встроенных правил. Результаты кэшируются по исходному URL, кэш
+        ограничен cache_size записями и вытесняет давно не встречавшиеся URL
+        (приближение LRU из двух поколений обычных словарей).
+    """
+
+    QUERY_MODES = ('keep', 'strip', 'template')
+
+    def __init__(self, ids=True, query='keep', rules=(), cache_size=65536):
+        if query not in self.QUERY_MODES:
+            raise ValueError('Unknown query mode: {}'.format(query))
+        self.ids = ids
+        self.query = query
+        self.rules = [(re.compile(pattern), repl) for pattern, repl in rules]
+        self.cache_size = cache_size
+        self.re_hex = re.compile(RE_URL_HEX)
+        self.re_uuid = re.compile(RE_URL_UUID)
+        self.cache = {}
+        self.old_cache = {}
+
+    @classmethod
+    def from_config(cls, settings):
+        """Нормализатор по значению URL_NORMALIZE из конфига; None - исходные URL."""
+        if not settings:
+            return None
+        return cls(**settings) if isinstance(settings, dict) else cls()
+
+    def segment(self, segment):
+        if segment.isdigit():
+            return '{id}'
+        if len(segment) >= 8:
+            if self.re_uuid.match(segment):
+                return '{uuid}'
+            if self.re_hex.match(segment) and not segment.isalpha():
+                return '{hex}'
+        return segment
+
+    def normalize(self, url):
+        for regex, repl in self.rules:
+            url = regex.sub(repl, url)
+        path, sep, query = url.partition('?')
+        if self.ids:
+            path = '/'.join(self.segment(segment) for segment in path.split('/'))
+        if self.query == 'strip':
+            return path
+        if sep and self.query == 'template':
+            params = (param.partition('=') for param in query.split('&'))
+            query = '&'.join(key + '={}' if eq else key for key, eq, _ in params)
+        return path + sep + query
+
+    def __call__(self, url):
+        result = self.cache.get(url)
+        if result is None:
+            result = self.old_cache.get(url)
+            if result is None:
+                result = self.normalize(url)
+            if len(self.cache) >= self.cache_size // 2:
+                self.old_cache = self.cache
+                self.cache = {}
+            self.cache[url] = result
+        return result
+
+
+def normalize_urls(items, normalizer):
+    """Этап между парсером и LogAnalyzer.get_data: подменяет URL шаблоном."""
+    for item in items:
+        if item:
+            item = (normalizer(item[0]),) + tuple(item[1:])
+        yield item
+
+
+def collect_series(items, series):
+    """ Этап перед LogAnalyzer.get_data: добавляет строки (url, request_time,
+        time_local) в ряды series и отдает дальше (url, request_time).
+    """
+    add = series.add
+    for item in items:
+        if item:
+            add(item[0], item[2], float(item[1]))
+            item = item[:2]
+        yield item
+
+
+class UrlSamples(list):
+    """Точные значения $request_time одного URL."""
+
+    __slots__ = ()
+
+    add = list.append
+
+    def total(self):
+        return sum(self)
+
+    def merge(self, other):
+        self.extend(other)
+
+    def summary(self):
+        # порядок значений сохраняется: от него зависит сумма при слиянии агрегатов
+        ordered = sorted(self)
+        return {'time_max': ordered[-1], 'time_med': LogAnalyzer.median(ordered)}
+
+    def dump(self):
+        return list(self)
+
+    def pack(self):
+        return array_to_bytes(array.array('d', self))
+
+    def to_sketch(self):
+        sketch = UrlSketch()
+        for value in self:
+            sketch.add(value)
+        return sketch
+
+    @classmethod
+    def load(cls, data):
+        return cls(data)
+
+    @classmethod
+    def unpack(cls, data):
+        values = array.array('d')
+        array_from_bytes(values, data)
+        return cls(values)
+
+
+class CompactSamples(object):
+    """ Значения $request_time одного URL целыми миллисекундами в array('I')
+        (4 байта на значение против ~32 у списка float) и сумма с максимумом.
+        $request_time пишется с точностью до миллисекунды, а ms / 1000.0 дает
+        тот же float, что и float() от исходной строки, поэтому статистика
+        совпадает с UrlSamples бит в бит.
+    """
+
+    __slots__ = ('time_sum', 'time_max', 'samples')
+
+    def __init__(self):
+        self.time_sum = 0.0
+        self.time_max = 0.0
+        self.samples = array.array('I')
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, value):
+        self.samples.append(int(round(value * 1000)))
+        self.time_sum += value
+        if value > self.time_max:
+            self.time_max = value
+
+    def total(self):
+        if self.time_sum is None:
+            # после слияния сумма пересчитывается в исходном порядке значений
+            self.time_sum = sum(ms / 1000.0 for ms in self.samples)
+        return self.time_sum
+
+    def merge(self, other):
+        self.samples.extend(other.samples)
+        self.time_sum = None
+        self.time_max = max(self.time_max, other.time_max)
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        length = len(ordered)
+        if length % 2:
+            med = ordered[length // 2] / 1000.0
+        else:
+            med = (ordered[length // 2 - 1] / 1000.0 + ordered[length // 2] / 1000.0) / 2.0
+        return {'time_max': self.time_max, 'time_med': med}
+
+    def dump(self):
+        return self.samples.tolist()
+
+    def pack(self):
+        return array_to_bytes(self.samples), self.total(), self.time_max
+
+    def to_sketch(self):
+        sketch = UrlSketch()
+        for ms in self.samples:
+            sketch.add(ms / 1000.0)
+        return sketch
+
+    @classmethod
+    def load(cls, data):
+        compact = cls()
+        compact.samples = array.array('I', data)
+        compact.time_sum = None
+        compact.time_max = max(data) / 1000.0 if data else 0.0
+        return compact
+
+    @classmethod
+    def unpack(cls, data):
+        compact = cls()
+        array_from_bytes(compact.samples, data[0])
+        compact.time_sum, compact.time_max = data[1:]
+        return compact
+
+
+class LatencyHistogram(object):
+    """ Логарифмическая гистограмма значений $request_time (в духе HDR/DDSketch).
+
+        Значение v попадает в корзину k = ceil(log(v) / log(GAMMA)), то есть
+        в интервал (GAMMA ** (k - 1), GAMMA ** k]. Представитель корзины отличается
+        от любого её значения не больше чем на ACCURACY относительно, поэтому
+        quantile(q) отстоит от точного значения ранга round(q * (n - 1)) не больше
+        чем на ACCURACY. Значения меньше MIN_VALUE считаются нулём. Число корзин
+        ограничено диапазоном: от MIN_VALUE до суток - около 950 корзин.
+        Гистограммы складываются без потери точности (merge).
+    """
+
+    __slots__ = ('zeros', 'buckets')
+
+    ACCURACY = 0.01
+    GAMMA = (1 + ACCURACY) / (1 - ACCURACY)
+    LOG_GAMMA = math.log(GAMMA)
+    MIN_VALUE = 0.0005
+
+    def __init__(self):
+        self.zeros = 0
+        self.buckets = {}
+
+    def add(self, value):
+        if value < self.MIN_VALUE:
+            self.zeros += 1
+        else:
+            key = int(math.ceil(math.log(value) / self.LOG_GAMMA))
+            self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def merge(self, other):
+        self.zeros += other.zeros
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    def quantile(self, q, count):
+        rank = int(round(q * (count - 1)))
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                return 2 * self.GAMMA ** key / (self.GAMMA + 1)
+        return 0.0
+
+    def dump(self):
+        return [self.zeros, [[key, self.buckets[key]] for key in sorted(self.buckets)]]
+
+    @classmethod
+    def load(cls, data):
+        histogram = cls()
+        histogram.zeros = data[0]
+        histogram.buckets = dict((key, count) for key, count in data[1])
+        return histogram
+
+
+class UrlSketch(object):
+    """ Агрегат одного URL фиксированного размера: точные count, сумма и максимум
+        плюс LatencyHistogram для медианы и перцентилей. Сумма копится целыми
+        миллисекундами, поэтому не зависит от порядка слияния агрегатов.
+    """
+
+    __slots__ = ('count', 'time_ms', 'time_max', 'histogram')
+
+    QUANTILES = (('time_med', 0.5), ('time_p95', 0.95), ('time_p99', 0.99))
+
+    def __init__(self):
+        self.count = 0
+        self.time_ms = 0
+        self.time_max = 0.0
+        self.histogram = LatencyHistogram()
+
+    def __len__(self):
+        return self.count
+
+    def add(self, value):
+        self.count += 1
+        self.time_ms += int(round(value * 1000))
+        if value > self.time_max:
+            self.time_max = value
+        self.histogram.add(value)
+
+    def total(self):
+        return self.time_ms / 1000.0
+
+    def merge(self, other):
+        self.count += other.count
+        self.time_ms += other.time_ms
+        self.time_max = max(self.time_max, other.time_max)
+        self.histogram.merge(other.histogram)
+
+    def summary(self):
+        data = {'time_max': self.time_max}
+        for name, q in self.QUANTILES:
+            data[name] = min(self.histogram.quantile(q, self.count), self.time_max)
+        return data
+
+    def dump(self):
+        return [self.count, self.total(), self.time_max, self.histogram.dump()]
+
+    def pack(self):
+        return self.count, self.time_ms, self.time_max, self.histogram.zeros, self.histogram.buckets
+
+    def to_sketch(self):
+        return self
+
+    @classmethod
+    def load(cls, data):
+        sketch = cls()
+        sketch.count, time_sum, sketch.time_max = data[:3]
+        sketch.time_ms = int(round(time_sum * 1000))
+        sketch.histogram = LatencyHistogram.load(data[3])
+        return sketch
+
+    @classmethod
+    def unpack(cls, data):
+        sketch = cls()
+        sketch.count, sketch.time_ms, sketch.time_max, sketch.histogram.zeros, sketch.histogram.buckets = data
+        return sketch
+
+
+class TimeSeries(object):
+    """ Ряды по времени для URL: в каждой корзине времени число запросов,
+        сумма $request_time и гистограмма по границам SERIES_BOUNDS.
+
+        Корзина - префикс $time_local ('29/Jun/2017:03:50' для минуты,
+        '29/Jun/2017:03' для часа), поэтому время не разбирается strptime.
+        Число ячеек (URL, корзина) ограничено budget: при превышении URL
+        с наименьшим числом запросов переводятся на более грубые корзины
+        (минута -> час -> день), а дневные ряды самых редких URL сливаются
+        в общий ряд OTHER, пока ячеек не станет 3/4 budget. Слитые URL
+        забываются, а URL, не встречавшиеся до первого слияния (full),
+        сразу идут в OTHER, поэтому память - O(budget) при любом числе URL.
+    """
+
+    WIDTHS = {'minute': 17, 'hour': 14, 'day': 11}
+    OTHER = '(other)'
+
+    def __init__(self, resolution='minute', budget=SERIES_BUDGET):
+        if resolution not in self.WIDTHS:
+            raise ValueError('Unknown series resolution: {}'.format(resolution))
+        self.resolution = resolution
+        self.budget = budget
+        self.widths = sorted((width for width in self.WIDTHS.values() if width <= self.WIDTHS[resolution]),
+                             reverse=True)
+        # url -> [уровень (индекс в widths), {корзина: ячейка}, число запросов]; у каждого URL есть
+        # ячейка, поэтому их не больше budget
+        self.urls = {}
+        self.cells = 0
+        # были слияния в OTHER: новые URL сразу идут в OTHER
+        self.full = False
+
+    def add(self, url, time_local, value):
+        entry = self.urls.get(url)
+        if entry is None:
+            if self.full:
+                entry = self.other()
+            else:
+                entry = self.urls[url] = [0, {}, 0]
+        entry[2] += 1
+        key = time_local[:self.widths[entry[0]]]
+        cell = entry[1].get(key)
+        if cell is None:
+            cell = entry[1][key] = [0, 0.0] + [0] * (len(SERIES_BOUNDS) + 1)
+            self.cells += 1
+        cell[0] += 1
+        cell[1] += value
+        cell[2 + bisect.bisect_left(SERIES_BOUNDS, value)] += 1
+        if self.cells > self.budget:
+            self.fold()
+
+    def other(self):
+        entry = self.urls.get(self.OTHER)
+        if entry is None:
+            entry = self.urls[self.OTHER] = [len(self.widths) - 1, {}, 0]
+        return entry
+
+    @staticmethod
+    def merge_cells(buckets, width, into):
+        """Добавляет ячейки buckets в into с ключами, укороченными до width. Возвращает число новых ячеек."""
+        added = 0
+        for key, cell in buckets.items():
+            key = key[:width]
+            target = into.get(key)
+            if target is None:
+                into[key] = list(cell)
+                added += 1
+            else:
+                for i, value in enumerate(cell):
+                    target[i] += value
+        return added
+
+    def coarsen(self, url, level):
+        """Переводит ряд url на уровень level (len(widths) - слияние в OTHER, после него url забывается)."""
+        entry = self.urls[url]
+        if entry[0] >= level:
+            return
+        buckets = entry[1]
+        self.cells -= len(buckets)
+        if level == len(self.widths):
+            del self.urls[url]
+            self.full = True
+            other = self.other()
+            other[2] += entry[2]
+            self.cells += self.merge_cells(buckets, self.widths[-1], other[1])
+            return
+        entry[1] = {}
+        self.cells += self.merge_cells(buckets, self.widths[level], entry[1])
+        entry[0] = level
+
+    def fold(self):
+        target = self.budget * 3 // 4
+        last = len(self.widths)
+        urls = self.urls
+        for level in range(last):
+            # на последнем шаге в OTHER сливаются ряды любой детализации,
+            # до него огрубление ряда из одной корзины ячеек не уменьшит
+            if level == last - 1:
+                candidates = [(entry[2], url) for url, entry in urls.items() if url != self.OTHER]
+            else:
+                candidates = [(entry[2], url) for url, entry in urls.items()
+                              if entry[0] == level and len(entry[1]) > 1 and url != self.OTHER]
+            heapq.heapify(candidates)
+            while candidates:
+                if self.cells <= target:
+                    return
+                _, url = heapq.heappop(candidates)
+                if level == last - 1:
+                    self.coarsen(url, last)
+                    continue
+                buckets = self.urls[url][1]
+                # огрубление, не уменьшающее число ячеек, только теряет детализацию
+                if len(set(key[:self.widths[level + 1]] for key in buckets)) < len(buckets):
+                    self.coarsen(url, level + 1)
+
+    def merge(self, other):
+        """ Добавляет ряды другого TimeSeries той же детализации. URL, которых
+            здесь нет, после первого слияния в OTHER (full) идут в OTHER.
+        """
+        if other.resolution != self.resolution:
+            raise ValueError('Cannot merge {} series into {}'.format(other.resolution, self.resolution))
+        for url, (level, buckets, count) in other.urls.items():
+            if url == self.OTHER or (self.full and url not in self.urls):
+                target = self.other()
+            else:
+                if url not in self.urls:
+                    self.urls[url] = [0, {}, 0]
+                self.coarsen(url, level)
+                target = self.urls[url]
+            target[2] += count
+            self.cells += self.merge_cells(buckets, self.widths[target[0]], target[1])
+        self.full = self.full or other.full
+        if self.cells > self.budget:
+            self.fold()
+
+    def dump(self):
+        return {'resolution': self.resolution, 'budget': self.budget, 'full': self.full,
+                'urls': [[url, level, count, [[key, cell] for key, cell in buckets.items()]]
+                         for url, (level, buckets, count) in self.urls.items()]}
+
+    @classmethod
+    def load(cls, data):
+        series = cls(data['resolution'], data['budget'])
+        series.full = data.get('full', False)
+        for url, level, count, buckets in data['urls']:
+            if level == len(series.widths):
+                # запись слитого URL из старого формата: его запросы уже в ряде OTHER
+                series.full = True
+                continue
+            series.urls[url] = [level, dict((key, cell) for key, cell in buckets), count]
+            series.cells += len(buckets)
+        return series
+
+    @staticmethod
+    def label(key):
+        """'29/Jun/2017:03:50' -> '2017-06-29 03:50', '29/Jun/2017:03' -> '2017-06-29 03:00'."""
+        date = '{}-{:02d}-{}'.format(key[7:11], MONTHS.get(key[3:6], 0), key[:2])
+        if len(key) == 11:
+            return date
+        return '{} {}:{}'.format(date, key[12:14], key[15:17] or '00')
+
+    def export(self, urls):
+        """ Ряды для отчета по списку urls и ряд OTHER: для URL - детализация
+            и точки [время, count, time_sum, гистограмма] по возрастанию времени.
+        """
+        names = dict((width, name) for name, width in self.WIDTHS.items())
+        series = {}
+        for url in list(urls) + [self.OTHER]:
+            entry = self.urls.get(url)
+            if entry is None:
+                continue
+            width = self.widths[entry[0]]
+            points = sorted([self.label(key), cell[0], cell[1], cell[2:]] for key, cell in entry[1].items())
+            series[url] = {'resolution': names[width], 'points': points}
+        return {'bounds': SERIES_BOUNDS, 'series': series}
+
+
 class LogAnalyzer:
 
-    def __init__(self, logiterator):
+    def __init__(self, logiterator, aggregation='exact'):
+        if aggregation not in AGGREGATIONS:
+            raise ValueError('Unknown aggregation: {}'.format(aggregation))
         self.logiterator = logiterator
-        self.time_sum_buf = defaultdict(list)
+        self.aggregation = aggregation
+        self.record = AGGREGATIONS[aggregation]
+        self.time_sum_buf = defaultdict(self.record)
+        # URL в порядке первого появления: по нему частичные агрегаты
+        # сливаются так же, как при последовательном разборе
+        self.urls = []
         self.table = []
-        self.all_time = 0.0
+        # общая сумма $request_time в целых миллисекундах ($request_time пишется с точностью до миллисекунды):
+        # складывается точно, поэтому не зависит от порядка строк и разбиения лога на части
+        self.all_ms = 0
         self.all_count = 0
+        # $request_time -> (значение, миллисекунды), см. _parse_time
+        self.times = {}
+        # TimeSeries, если ряды по времени включены (см. make_analyzer и collect_series)
+        self.series = None
+        self.next_check = sys.maxsize
 
     def get_data(self):
-        for item in self.logiterator:
+        self.add_items(self.logiterator)
+        logging.info('Done')
+
+    def add_items(self, items, added=None):
+        """ Добавляет разобранные строки items (кортежи url, request_time, ...
+            или None) в агрегаты URL. В список added, если он передан,
+            дописываются пары (url, значение) добавленных строк. Каждые
+            next_check строк вызывается check_memory (см. SpillingAnalyzer).
+        """
+        time_sum_buf = self.time_sum_buf
+        times = self.times
+        next_check = self.next_check
+        for item in items:
             if item:
+                url = item[0]
+                parsed = times.get(item[1])
+                if parsed is None:
+                    parsed = self._parse_time(item[1])
+                value, ms = parsed
+                samples = time_sum_buf.get(url)
+                if samples is None:
+                    url, samples = self._new_record(url)
+                samples.add(value)
                 self.all_count += 1
-                self.time_sum_buf[item[0]].append(float(item[1]))
-                self.all_time += float(item[1])
-        logging.info('Done')
+                self.all_ms += ms
+                if added is not None:
+                    added.append((url, value))
+                if self.all_count >= next_check:
+                    self.check_memory()
+                    next_check = self.next_check
+
+    def _parse_time(self, request_time):
+        """ Значение $request_time и оно же в целых миллисекундах. Значения
+            повторяются, поэтому кэшируются (не больше TIME_CACHE_SIZE).
+        """
+        value = float(request_time)
+        if len(self.times) >= TIME_CACHE_SIZE:
+            self.times.clear()
+        parsed = self.times[request_time] = (value, int(round(value * 1000)))
+        return parsed
+
+    def check_memory(self):
+        """Ограничения памяти у LogAnalyzer нет, next_check (sys.maxsize) не наступает."""
+
+    def _new_record(self, url):
+        url = intern(url)
+        samples = self.time_sum_buf[url] = self.record()
+        self.urls.append(url)
+        return url, samples
+
+    def dump_state(self, sketch=False):
+        """ Частичный агрегат: сериализуемое состояние анализатора. С sketch=True
+            агрегаты URL приводятся к UrlSketch фиксированного размера.
+        """
+        state = self.dump_header(sketch)
+        state['urls'] = list(self.dump_urls(sketch))
+        return state
+
+    def pack_state(self):
+        """ Частичный агрегат для передачи между процессами: как dump_state,
+            но агрегаты URL упакованы методом pack (массивы значений - в байты),
+            а не приведены к спискам для JSON.
+        """
+        state = self.dump_header()
+        state['urls'] = [(url, self.time_sum_buf[url].pack()) for url in self.urls]
+        state['packed'] = True
+        return state
+
+    def dump_header(self, sketch=False):
+        """Частичный агрегат без списка URL (см. dump_urls)."""
+        state = {'aggregation': 'sketch' if sketch else self.aggregation, 'all_count': self.all_count,
+                 'all_ms': self.all_ms}
+        if self.series is not None:
+            state['series'] = self.series.dump()
+        return state
+
+    def dump_urls(self, sketch=False):
+        """Записи [url, агрегат] частичного агрегата по одной."""
+        for url in self.urls:
+            samples = self.time_sum_buf[url]
+            yield [url, (samples.to_sketch() if sketch else samples).dump()]
+
+    def merge_state(self, state):
+        """ Добавляет частичный агрегат, полученный dump_state. Суммы в целых
+            миллисекундах складываются точно, поэтому слияние частей дает ту же
+            общую сумму, что и разбор целиком. Принимает и состояние pack_state.
+        """
+        if state['aggregation'] != self.aggregation:
+            raise ValueError('Cannot merge {} aggregates into {}'.format(state['aggregation'], self.aggregation))
+        time_sum_buf = self.time_sum_buf
+        load = self.record.unpack if state.get('packed') else self.record.load
+        totals = []
+        for url, data in state['urls']:
+            samples = load(data)
+            totals.append(samples.total())
+            if url in time_sum_buf:
+                time_sum_buf[url].merge(samples)
+            else:
+                time_sum_buf[url] = samples
+                self.urls.append(url)
+        self.all_count += state['all_count']
+        if 'all_ms' in state:
+            self.all_ms += state['all_ms']
+        else:
+            # в агрегатах старого формата сумма в секундах или не сохранена вовсе
+            self.all_ms += int(round(state.get('all_time', math.fsum(totals)) * 1000))
+        if self.series is not None and 'series' in state:
+            self.series.merge(TimeSeries.load(state['series']))
 
     @staticmethod
     def median(seq):
@@ -95,45 +1257,920 @@ class LogAnalyzer:
     def count_perc(self, count):
         return (float(count) * 100) / self.all_count
 
+    @property
+    def all_time(self):
+        return self.all_ms / 1000.0
+
     def time_perc_sum(self, summ):
         return (summ * 100) / self.all_time
 
+    def url_stats(self, url, samples):
+        count = len(samples)
+        summ = samples.total()
+        data = {'url': url, 'count_perc': self.count_perc(count), 'time_perc': self.time_perc_sum(summ),
+                'time_avg': summ / count, 'time_sum': summ, 'count': count}
+        data.update(samples.summary())
+        return data
+
     def calc(self):
+        """Статистика всех URL в порядке их первого появления в логе."""
         logging.info('Reading...')
         self.get_data()
         logging.info('Data analyze...')
-        for url in self.time_sum_buf:
-            count = len(self.time_sum_buf[url])
-            summ = sum(self.time_sum_buf[url])
-            self.time_sum_buf[url].sort()
-            data = {'url': url, 'count_perc': self.count_perc(count), 'time_perc': self.time_perc_sum(summ),
-                    'time_avg': summ / count, 'time_max': self.time_sum_buf[url][-1],
-                    'time_med': self.median(self.time_sum_buf[url]), 'time_sum': summ, 'count': count}
-            yield data
+        for url in self.urls:
+            yield self.url_stats(url, self.time_sum_buf[url])
         logging.info('Done')
 
+    def close(self):
+        """Освобождает ресурсы анализатора; у LogAnalyzer их нет (см. SpillingAnalyzer)."""
 
-def get_last_log(path):
-    max = 0
-    log_file = ''
-    result = None
+    def top(self, size):
+        """ Статистика size URL с наибольшим time_sum по убыванию time_sum.
+            URL отбираются кучей по суммам, медиана и максимум считаются только
+            для попавших в отчет. Результат совпадает с первыми size элементами
+            calc(), отсортированного по time_sum: при равных суммах выше URL,
+            появившийся в логе раньше (так же ранжируют SpillingAnalyzer и LiveAnalyzer).
+        """
+        logging.info('Reading...')
+        self.get_data()
+        logging.info('Data analyze...')
+        time_sum_buf = self.time_sum_buf
+        # nlargest устойчив: ничьи разрешаются порядком self.urls, а не порядком словаря
+        ranked = heapq.nlargest(size, self.urls, key=lambda url: time_sum_buf[url].total())
+        data = [self.url_stats(url, time_sum_buf[url]) for url in ranked]
+        logging.info('Done')
+        return data
+
+
+class SpillingAnalyzer(LogAnalyzer):
+    """ LogAnalyzer с ограничением памяти. Каждые SPILL_CHECK_EVERY строк
+        проверяется число URL в памяти (max_keys) и грубая оценка занятых байт
+        (max_bytes, см. SPILL_KEY_BYTES и SPILL_VALUE_BYTES). При превышении
+        агрегаты URL дописываются в partitions временных файлов по хэшу URL,
+        и память освобождается. top(), calc() и dump_urls() сливают файлы по одному, поэтому
+        в памяти одновременно только одна часть URL.
+
+        Записи одного URL сливаются в порядке сброса, а ничьи по time_sum
+        разрешаются по порядку первого появления URL, поэтому отчет совпадает
+        с LogAnalyzer.
+    """
+
+    def __init__(self, logiterator, aggregation='exact', max_keys=None, max_bytes=None,
+                 partitions=SPILL_PARTITIONS, spill_dir=None):
+        LogAnalyzer.__init__(self, logiterator, aggregation)
+        self.max_keys = max_keys
+        self.max_bytes = max_bytes
+        self.partitions = partitions
+        self.spill_dir = spill_dir
+        self.tmp = None
+        # порядковый номер первого появления для URL из self.urls - base_seq + индекс
+        self.base_seq = 0
+        self.spilled_count = 0
+        self.key_bytes = 0
+        self.next_check = SPILL_CHECK_EVERY
+
+    def _new_record(self, url):
+        url, samples = LogAnalyzer._new_record(self, url)
+        self.key_bytes += len(url)
+        return url, samples
+
+    def merge_state(self, state):
+        known = len(self.urls)
+        LogAnalyzer.merge_state(self, state)
+        self.key_bytes += sum(len(url) for url in self.urls[known:])
+        self.check_memory()
+
+    def memory_estimate(self):
+        return (len(self.urls) * SPILL_KEY_BYTES[self.aggregation] + self.key_bytes +
+                (self.all_count - self.spilled_count) * SPILL_VALUE_BYTES[self.aggregation])
+
+    def check_memory(self):
+        self.next_check = self.all_count + SPILL_CHECK_EVERY
+        if ((self.max_keys and len(self.urls) > self.max_keys) or
+                (self.max_bytes and self.memory_estimate() > self.max_bytes)):
+            self.spill()
+
+    def partition(self, url):
+        return zlib.crc32(url.encode('utf-8', 'surrogateescape') if PY3 else url) % self.partitions
+
+    def partition_path(self, index):
+        return os.path.join(self.tmp, 'part-{}.json'.format(index))
+
+    def spill(self):
+        """Дописывает агрегаты из памяти в файлы частей и очищает память."""
+        if not self.urls:
+            return
+        if not self.tmp:
+            self.tmp = tempfile.mkdtemp(prefix='log_analyzer-', dir=self.spill_dir)
+        logging.info('Spilling {} URLs to {}'.format(len(self.urls), self.tmp))
+        parts = defaultdict(list)
+        for seq, url in enumerate(self.urls, self.base_seq):
+            parts[self.partition(url)].append(json.dumps([seq, url, self.time_sum_buf[url].dump()]))
+        for index, lines in parts.items():
+            with open(self.partition_path(index), 'a') as part:
+                part.write('\n'.join(lines))
+                part.write('\n')
+        self.base_seq += len(self.urls)
+        self.urls = []
+        self.time_sum_buf.clear()
+        self.spilled_count = self.all_count
+        self.key_bytes = 0
+
+    def merged_partitions(self):
+        """ Части по одной: списки (seq, url, запись) со слитыми записями всех
+            сбросов. Оставшиеся в памяти агрегаты сначала тоже сбрасываются.
+        """
+        self.spill()
+        for index in range(self.partitions):
+            path = self.partition_path(index)
+            if not os.path.exists(path):
+                continue
+            merged = {}
+            with open(path) as part:
+                for line in part:
+                    seq, url, data = json.loads(line)
+                    samples = self.record.load(data)
+                    if url in merged:
+                        merged[url][2].merge(samples)
+                    else:
+                        merged[url] = [seq, url, samples]
+            yield list(merged.values())
+
+    def calc(self):
+        logging.info('Reading...')
+        self.get_data()
+        logging.info('Data analyze...')
+        if not self.tmp:
+            for url in self.urls:
+                yield self.url_stats(url, self.time_sum_buf[url])
+            logging.info('Done')
+            return
+        for part in self.merged_partitions():
+            for _, url, samples in part:
+                yield self.url_stats(url, samples)
+        logging.info('Done')
+
+    def top(self, size):
+        logging.info('Reading...')
+        self.get_data()
+        if not self.tmp:
+            return LogAnalyzer.top(self, size)
+        logging.info('Data analyze...')
+        heap = []
+        for part in self.merged_partitions():
+            for seq, url, samples in part:
+                total = samples.total()
+                # при равных суммах выше URL, появившийся раньше, как в LogAnalyzer.top
+                entry = ((total, -seq), url, samples)
+                if len(heap) < size:
+                    heapq.heappush(heap, entry)
+                elif size and entry[0] > heap[0][0]:
+                    heapq.heapreplace(heap, entry)
+        heap.sort(reverse=True, key=operator.itemgetter(0))
+        data = [self.url_stats(url, samples) for _, url, samples in heap]
+        logging.info('Done')
+        return data
+
+    def dump_state(self, sketch=False):
+        """ Частичный агрегат в порядке первого появления URL. После сброса
+            он собирается в памяти целиком, поэтому для записи на диск нужны
+            dump_header и dump_urls (см. save_aggregate).
+        """
+        if not self.tmp:
+            return LogAnalyzer.dump_state(self, sketch)
+        entries = sorted((entry for part in self.merged_partitions() for entry in part),
+                         key=operator.itemgetter(0))
+        state = self.dump_header(sketch)
+        state['urls'] = [[url, (samples.to_sketch() if sketch else samples).dump()] for _, url, samples in entries]
+        return state
+
+    def dump_urls(self, sketch=False):
+        """Записи [url, агрегат] по частям: в памяти одновременно только одна часть."""
+        if not self.tmp:
+            for entry in LogAnalyzer.dump_urls(self, sketch):
+                yield entry
+            return
+        for part in self.merged_partitions():
+            for _, url, samples in sorted(part, key=operator.itemgetter(0)):
+                yield [url, (samples.to_sketch() if sketch else samples).dump()]
+
+    def close(self):
+        """Удаляет временные файлы частей."""
+        if self.tmp:
+            shutil.rmtree(self.tmp, ignore_errors=True)
+            self.tmp = None
+
+
+def report_series(analyzer, data):
+    """Ряды по времени для URL строк отчета data или None, если ряды не собирались."""
+    if analyzer.series is None:
+        return None
+    return analyzer.series.export(row['url'] for row in data)
+
+
+def make_analyzer(aggregation):
+    """ Пустой анализатор в режиме aggregation: SpillingAnalyzer, если в конфиге
+        задан SPILL_MAX_KEYS или SPILL_MAX_MB, иначе LogAnalyzer. При TIME_SERIES
+        анализатор собирает ряды по времени.
+    """
+    max_keys = config.get('SPILL_MAX_KEYS')
+    max_mb = config.get('SPILL_MAX_MB')
+    if not (max_keys or max_mb):
+        analyzer = LogAnalyzer(iter(()), aggregation)
+    else:
+        analyzer = SpillingAnalyzer(iter(()), aggregation, max_keys, max_mb and max_mb * 1048576,
+                                    config.get('SPILL_PARTITIONS', SPILL_PARTITIONS), config.get('SPILL_DIR'))
+    if config.get('TIME_SERIES'):
+        analyzer.series = TimeSeries(config['TIME_SERIES'], config.get('SERIES_BUDGET', SERIES_BUDGET))
+    return analyzer
+
+
+def analyze_range(task):
+    """Разбор и агрегация одного диапазона байт лога в процессе пула."""
+    log, start, end, log_format, aggregation, normalize, series = task
+    stats = {}
+    items = log_generator(log, LogFormatParser(log_format, series_fields(series)), error_threshold=None,
+                          start=start, end=end, stats=stats)
+    normalizer = UrlNormalizer.from_config(normalize)
+    if normalizer:
+        items = normalize_urls(items, normalizer)
+    analyzer = LogAnalyzer(items, aggregation)
+    if series:
+        analyzer.series = TimeSeries(*series)
+        analyzer.logiterator = collect_series(items, analyzer.series)
+    analyzer.get_data()
+    return analyzer.pack_state(), stats['lines'], stats['errors']
+
+
+def parallel_analyzer(log, workers, log_format=LOG_FORMAT, aggregation='exact', error_threshold=0.4,
+                      normalize=None, start=0, analyzer=None, stats=None, on_progress=None,
+                      progress_every=PROGRESS_EVERY, end=None):
+    """ Разбирает plain-лог с позиции start по диапазонам байт в пуле из workers
+        процессов. Частичные агрегаты сливаются в порядке диапазонов, поэтому
+        результат calc() совпадает с последовательным разбором. normalize -
+        настройки UrlNormalizer (значение URL_NORMALIZE из конфига). Данные
+        добавляются в analyzer, если он передан; stats и on_progress - как
+        в log_generator, on_progress вызывается после диапазона, на котором
+        набралось очередные progress_every строк. end - конец разбираемого
+        диапазона байт (по умолчанию до конца файла).
+    """
+    analyzer = analyzer or LogAnalyzer(iter(()), aggregation)
+    series = (analyzer.series.resolution, analyzer.series.budget) if analyzer.series is not None else None
+    tasks = [(log, part_start, part_end, log_format, aggregation, normalize, series)
+             for part_start, part_end in split_log(log, workers * 4, start, end)]
+    stats = {} if stats is None else stats
+    stats.update(offset=start, lines=0, errors=0)
+    next_progress = progress_every
+    pool = multiprocessing.Pool(workers)
+    try:
+        for i, (state, lines, errors) in enumerate(pool.imap(analyze_range, tasks)):
+            analyzer.merge_state(state)
+            stats['offset'] = tasks[i][2]
+            stats['lines'] += lines
+            stats['errors'] += errors
+            if on_progress and stats['lines'] >= next_progress:
+                on_progress(stats)
+                next_progress = stats['lines'] + progress_every
+    finally:
+        pool.close()
+        pool.join()
+    check_errors(stats['lines'], stats['errors'], error_threshold)
+    return analyzer
+
+
+def series_fields(series):
+    """Поля парсера: с рядами по времени нужен еще $time_local."""
+    return ('url', 'request_time', 'time_local') if series else ('url', 'request_time')
+
+
+def analyze_log(analyzer, log, start=0, stats=None, on_progress=None, workers=None, end=None):
+    """ Разбирает лог с позиции start (у plain-лога - до end, если задан)
+        с настройками из config (LOG_FORMAT, URL_NORMALIZE, WORKERS)
+        и добавляет данные в analyzer.
+    """
+    log_format = config.get('LOG_FORMAT', LOG_FORMAT)
+    normalize = config.get('URL_NORMALIZE')
+    workers = workers or config.get('WORKERS', 1)
+    progress_every = config.get('PROGRESS_EVERY', PROGRESS_EVERY)
+    if workers > 1 and not log.endswith('.gz'):
+        parallel_analyzer(log, workers, log_format, analyzer.aggregation, normalize=normalize, start=start,
+                          analyzer=analyzer, stats=stats, on_progress=on_progress, progress_every=progress_every,
+                          end=end)
+    else:
+        items = log_generator(log, LogFormatParser(log_format, series_fields(analyzer.series)), start=start,
+                              end=end, stats=stats, on_progress=on_progress, progress_every=progress_every)
+        normalizer = UrlNormalizer.from_config(normalize)
+        if normalizer:
+            items = normalize_urls(items, normalizer)
+        if analyzer.series is not None:
+            items = collect_series(items, analyzer.series)
+        analyzer.logiterator = timed_items(items, stats) if stats is not None else items
+        analyzer.get_data()
+    return analyzer
+
+
+def timed_items(items, stats, every=TIMING_EVERY):
+    """ Пропускает элементы items, замеряя у каждого every-го время его получения
+        (чтение, ожидание распаковки и разбор строки) и время до запроса
+        следующего (агрегация). Общее время прохода делится между ними
+        в пропорции замеров и пишется в stats как parse_wall и aggregate_wall.
+        Остальные элементы проходят через islice и chain без кода на Python,
+        поэтому разбор не замедляется.
+    """
+    return itertools.chain.from_iterable(_timed_chunks(iter(items), stats, every))
+
+
+def _timed_chunks(items, stats, every):
+    clock = getattr(time, 'perf_counter', time.time)
+    end = object()
+    parse = aggregate = 0.0
+    begin = clock()
+    try:
+        while True:
+            yield itertools.islice(items, every - 1)
+            started = clock()
+            item = next(items, end)
+            if item is end:
+                break
+            produced = clock()
+            yield (item,)
+            parse += produced - started
+            aggregate += clock() - produced
+    finally:
+        # замеры отдельных элементов завышены временем самих замеров, пропорция точнее
+        total = clock() - begin
+        share = parse / (parse + aggregate) if parse + aggregate else 1.0
+        stats.update(parse_wall=total * share, aggregate_wall=total * (1 - share))
+
+
+def sample_blocks(log, rate, rnd=random, block_size=SAMPLE_BLOCK_SIZE, stats=None):
+    """ Случайная выборка блоков лога: генератор списков строк выбранных блоков.
+        plain-лог делится на блоки по block_size байт, из них без возвращения
+        выбирается доля rate (хотя бы один блок) и читается в случайном порядке;
+        строка относится к блоку, в котором начинается. В gzip-логе блоки -
+        пачки gzip_batches, каждая берется с вероятностью rate, но распаковывается
+        весь лог. В любом случае каждая строка попадает в выборку с одной и той же
+        вероятностью. Общее число блоков записывается в stats['blocks'].
+    """
+    if not 0 < rate <= 1:
+        raise ValueError('Sample rate must be in (0, 1]: {}'.format(rate))
+    stats = {} if stats is None else stats
+    if log.endswith('.gz'):
+        stats['blocks'] = 0
+        for batch in gzip_batches(log, config.get('GZIP_DECOMPRESSOR', 'auto'), block_size):
+            stats['blocks'] += 1
+            if rnd.random() < rate:
+                yield batch
+        return
+    size = os.path.getsize(log)
+    stats['blocks'] = blocks = (size + block_size - 1) // block_size
+    with open(log, 'rb') as log_file:
+        for block in rnd.sample(range(blocks), max(1, int(round(blocks * rate))) if blocks else 0):
+            start = line_start(log_file, block * block_size)
+            yield list(read_log(log, start, min((block + 1) * block_size, size)))
+
+
+class SampleAnalyzer(LogAnalyzer):
+    """ Оценка статистики лога по выборке блоков (см. sample_blocks). Строки
+        выбранных блоков разбираются как обычно, а count и time_sum URL
+        масштабируются на весь лог с 95% доверительными интервалами
+        (count_ci, time_sum_ci - полуширина интервала). Для каждого URL
+        копятся суммы и суммы квадратов по блокам: дисперсия оценки считается
+        как для кластерной выборки без возвращения. Медиана и p95 оцениваются
+        по выборочным значениям с интервалами по порядковым статистикам.
+    """
+
+    def __init__(self, aggregation='exact'):
+        LogAnalyzer.__init__(self, iter(()), aggregation)
+        # url -> [сумма count по блокам, сумма квадратов, сумма time_sum, сумма квадратов]
+        self.block_sums = {}
+        self.blocks = 0
+        self.total_blocks = 0
+        self.lines = 0
+        self.errors = 0
+
+    def add_block(self, items):
+        items = list(items)
+        added = []
+        self.add_items(items, added)
+        self.lines += len(items)
+        self.errors += len(items) - len(added)
+        block = {}
+        for url, request_time in added:
+            sums = block.get(url)
+            if sums is None:
+                sums = block[url] = [0, 0.0]
+            sums[0] += 1
+            sums[1] += request_time
+        for url, (count, summ) in block.items():
+            sums = self.block_sums.get(url)
+            if sums is None:
+                sums = self.block_sums[url] = [0, 0, 0.0, 0.0]
+            sums[0] += count
+            sums[1] += count * count
+            sums[2] += summ
+            sums[3] += summ * summ
+        self.blocks += 1
+
+    @property
+    def scale(self):
+        return float(self.total_blocks) / self.blocks if self.blocks else 0.0
+
+    def interval(self, total, squares):
+        """Полуширина интервала для оценки суммы по сумме и сумме квадратов значений блоков."""
+        blocks, sampled = self.total_blocks, self.blocks
+        if sampled < 2:
+            return None
+        variance = (squares - float(total) * total / sampled) / (sampled - 1)
+        return CONFIDENCE_Z * blocks * math.sqrt(max(variance, 0.0) * (1 - float(sampled) / blocks) / sampled)
+
+    @staticmethod
+    def quantile(ordered, q):
+        """Выборочный квантиль и границы его интервала по порядковым статистикам."""
+        length = len(ordered)
+        spread = CONFIDENCE_Z * math.sqrt(length * q * (1 - q))
+        low = max(int(math.floor(length * q - spread)), 0)
+        high = min(int(math.ceil(length * q + spread)), length - 1)
+        return ordered[min(int(length * q), length - 1)], ordered[low], ordered[high]
+
+    def url_stats(self, url, samples):
+        data = LogAnalyzer.url_stats(self, url, samples)
+        count, count_squares, summ, summ_squares = self.block_sums[url]
+        ordered = sorted(samples.dump())
+        data.update(count=count * self.scale, count_ci=self.interval(count, count_squares),
+                    time_sum=summ * self.scale, time_sum_ci=self.interval(summ, summ_squares))
+        for name, q in (('time_med', 0.5), ('time_p95', 0.95)):
+            value, low, high = self.quantile(ordered, q)
+            data.setdefault(name, value)
+            data[name + '_low'], data[name + '_high'] = low, high
+        return data
+
+
+def sample_log(log, rate=SAMPLE_RATE, seed=None, block_size=SAMPLE_BLOCK_SIZE, error_check=SAMPLE_ERROR_CHECK):
+    """ Разбирает случайную выборку из доли rate блоков лога и возвращает
+        SampleAnalyzer. Доля ошибок парсинга пишется в лог уже после первых
+        error_check строк выборки, чтобы смена формата была видна сразу.
+    """
+    parser = LogFormatParser(config.get('LOG_FORMAT', LOG_FORMAT))
+    normalizer = UrlNormalizer.from_config(config.get('URL_NORMALIZE'))
+    analyzer = SampleAnalyzer()
+    stats = {}
+    checked = False
+    for lines in sample_blocks(log, rate, random.Random(seed), block_size, stats):
+        items = [parser(line) for line in lines if line]
+        if normalizer:
+            items = normalize_urls(items, normalizer)
+        analyzer.add_block(items)
+        if not checked and analyzer.lines >= error_check:
+            checked = True
+            logging.info('Parse errors: {} of the first {} sampled lines'.format(analyzer.errors, analyzer.lines))
+            check_errors(analyzer.lines, analyzer.errors, 0.4)
+    analyzer.total_blocks = stats['blocks']
+    logging.info('Sampled {} of {} blocks: {} lines, {} parse errors'.format(
+        analyzer.blocks, analyzer.total_blocks, analyzer.lines, analyzer.errors))
+    return analyzer
+
+
+class LiveAnalyzer(LogAnalyzer):
+    """ LogAnalyzer для --follow: строки добавляются порциями (add), а top()
+        пересчитывает только URL, изменившиеся с прошлого вызова. Суммы
+        $request_time только растут, поэтому новый top выбирается из прошлого
+        top и измененных URL, без сортировки всех URL; медиана и максимум
+        пересчитываются только для измененных.
+
+        По умолчанию агрегация sketch: сумма и медиана URL берутся из агрегата
+        фиксированного размера, и обновление зависит только от числа новых
+        строк. В exact и compact медиана изменившегося URL считается сортировкой
+        всех его значений, то есть растет с объемом лога за день.
+    """
+
+    def __init__(self, aggregation='sketch'):
+        LogAnalyzer.__init__(self, iter(()), aggregation)
+        # url -> порядковый номер первого появления: им разрешаются ничьи по time_sum
+        self.seq = {}
+        self.dirty = set()
+        self.ranked = []
+        self.summaries = {}
+
+    def add(self, items):
+        added = []
+        self.add_items(items, added)
+        self.dirty.update(url for url, _ in added)
+
+    def _new_record(self, url):
+        url, samples = LogAnalyzer._new_record(self, url)
+        self.seq[url] = len(self.seq)
+        return url, samples
+
+    def reset(self):
+        """Сбрасывает накопленные данные (ротация или усечение лога)."""
+        series = self.series
+        self.__init__(self.aggregation)
+        if series is not None:
+            self.series = TimeSeries(series.resolution, series.budget)
+
+    def top(self, size):
+        seq = self.seq
+        totals = dict((url, self.time_sum_buf[url].total()) for url in set(self.ranked) | self.dirty)
+        # при равных суммах выше URL, появившийся раньше, как в LogAnalyzer.top
+        ranked = heapq.nlargest(size, totals, key=lambda url: (totals[url], -seq[url]))
+        summaries = {}
+        data = []
+        for url in ranked:
+            samples = self.time_sum_buf[url]
+            summary = self.summaries.get(url) if url not in self.dirty else None
+            summaries[url] = summary = summary or samples.summary()
+            count = len(samples)
+            summ = totals[url]
+            row = {'url': url, 'count_perc': self.count_perc(count), 'time_perc': self.time_perc_sum(summ),
+                   'time_avg': summ / count, 'time_sum': summ, 'count': count}
+            row.update(summary)
+            data.append(row)
+        self.ranked = ranked
+        self.summaries = summaries
+        self.dirty = set()
+        return data
+
+
+ROTATED = object()
+
+
+def _tail_producer(path, batches, stop, poll):
+    """ Поток --follow: читает path с начала и дальше по мере роста, передавая
+        пачки целых строк. Если path указывает на другой файл (ротация), старый
+        дочитывается и открывается новый, при усечении чтение идет с начала;
+        в обоих случаях перед новыми строками передается ROTATED.
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    log_file = None
+    tail = b''
+    try:
+        while not stop.is_set():
+            if log_file is None:
+                try:
+                    log_file = open(path, 'rb')
+                except IOError:
+                    stop.wait(poll)
+                    continue
+                tail = b''
+            data = log_file.read(FOLLOW_BLOCK_SIZE)
+            if data:
+                data = tail + data
+                cut = data.rfind(b'\n') + 1
+                tail = data[cut:]
+                if cut and not put(split_lines(data[:cut])):
+                    return
+                continue
+            opened = os.fstat(log_file.fileno())
+            try:
+                current = os.stat(path)
+            except OSError:
+                # старый файл переименован, а новый еще не создан: ждем, дочитывая старый
+                current = opened
+            if (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino):
+                log_file.close()
+                log_file = None
+                if not put(ROTATED):
+                    return
+            elif opened.st_size < log_file.tell():
+                log_file.seek(0)
+                tail = b''
+                if not put(ROTATED):
+                    return
+            else:
+                stop.wait(poll)
+    except Exception as e:
+        put(e)
+    finally:
+        if log_file is not None:
+            log_file.close()
+
+
+def follow(path, report_path, interval=FOLLOW_INTERVAL, poll=FOLLOW_POLL, stop=None):
+    """ Режим --follow: разбирает растущий лог path по мере записи и каждые
+        interval секунд перестраивает отчет report_path, если данные изменились.
+        После ротации или усечения лога данные накапливаются заново.
+        Работает, пока не установлено событие stop.
+    """
+    stop = stop or threading.Event()
+    analyzer = LiveAnalyzer(config.get('FOLLOW_AGGREGATION', 'sketch'))
+    if config.get('TIME_SERIES'):
+        analyzer.series = TimeSeries(config['TIME_SERIES'], config.get('SERIES_BUDGET', SERIES_BUDGET))
+    parser = LogFormatParser(config.get('LOG_FORMAT', LOG_FORMAT), series_fields(analyzer.series))
+    normalizer = UrlNormalizer.from_config(config.get('URL_NORMALIZE'))
+    batches = Queue(GZIP_QUEUE_SIZE)
+    reader = threading.Thread(target=_tail_producer, args=(path, batches, stop, poll))
+    reader.daemon = True
+    reader.start()
+    changed = True
+    next_report = time.time() + interval
+    logging.info('Following {}'.format(path))
+    try:
+        while not stop.is_set():
+            try:
+                batch = batches.get(timeout=max(min(poll, next_report - time.time()), 0.01))
+            except Empty:
+                batch = None
+            if batch is ROTATED:
+                logging.info('{} was rotated or truncated, starting over'.format(path))
+                analyzer.reset()
+                changed = True
+            elif isinstance(batch, Exception):
+                raise batch
+            elif batch:
+                items = [parser(line) for line in batch]
+                if normalizer:
+                    items = normalize_urls(items, normalizer)
+                if analyzer.series is not None:
+                    items = collect_series(items, analyzer.series)
+                analyzer.add(items)
+                changed = True
+            if time.time() >= next_report:
+                next_report = time.time() + interval
+                if changed and analyzer.all_count:
+                    data = analyzer.top(config['REPORT_SIZE'])
+                    report(data, report_path, series=report_series(analyzer, data))
+                    changed = False
+    finally:
+        stop.set()
+        reader.join()
+
+
+def analysis_settings():
+    """Настройки, от которых зависит содержимое агрегатов."""
+    return {'LOG_FORMAT': config.get('LOG_FORMAT', LOG_FORMAT),
+            'AGGREGATION': config.get('AGGREGATION', 'exact'),
+            'URL_NORMALIZE': config.get('URL_NORMALIZE'),
+            'TIME_SERIES': config.get('TIME_SERIES')}
+
+
+def ts_sibling(suffix):
+    """Путь рядом с TS_FILE: /var/tmp/log_analyzer.ts -> /var/tmp/log_analyzer<suffix>."""
+    return os.path.splitext(config['TS_FILE'])[0] + suffix
+
+
+def log_fingerprint(log, head_size=FINGERPRINT_SIZE):
+    """Отпечаток файла лога: устройство, inode, размер и хэш начала файла."""
+    log_stat = os.stat(log)
+    with open(log, 'rb') as log_file:
+        head = log_file.read(head_size)
+    return {'dev': log_stat.st_dev, 'ino': log_stat.st_ino, 'size': log_stat.st_size,
+            'head': hashlib.sha1(head).hexdigest(), 'head_size': len(head)}
+
+
+def save_checkpoint(path, log, analyzer, offset, lines, complete=False):
+    """ Атомарно сохраняет контрольную точку: первой строкой заголовок (позиция
+        в логе и его отпечаток), второй - частичный агрегат анализатора.
+    """
+    checkpoint = {'version': CHECKPOINT_VERSION, 'log': log, 'fingerprint': log_fingerprint(log),
+                  'settings': analysis_settings(), 'offset': offset, 'lines': lines, 'complete': complete}
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+        checkpoint_file.write('\n')
+        json.dump(analyzer.dump_state(), checkpoint_file)
+        checkpoint_file.write('\n')
+    os.rename(tmp_path, path)
+
+
+def load_checkpoint(path, log, state=True):
+    """ Контрольная точка для log или None, если её нет, она записана для
+        другого файла или настроек, либо файл с тех пор подменен или обрезан.
+        Переименование при ротации точку не сбрасывает: сравниваются inode
+        и хэш начала файла, а не путь. С state=False читается только заголовок:
+        этого достаточно, чтобы решить, нужен ли разбор.
+    """
+    try:
+        with open(path) as checkpoint_file:
+            checkpoint = json.loads(checkpoint_file.readline())
+            if checkpoint.get('version') != CHECKPOINT_VERSION or checkpoint['settings'] != analysis_settings():
+                return None
+            saved = checkpoint['fingerprint']
+            current = log_fingerprint(log, saved['head_size'])
+            if (current['dev'], current['ino'], current['head']) != (saved['dev'], saved['ino'], saved['head']):
+                return None
+            if current['size'] < saved['size'] or log.endswith('.gz') and current['size'] != saved['size']:
+                return None
+            if state:
+                checkpoint['state'] = json.loads(checkpoint_file.readline())
+    except (IOError, OSError, ValueError):
+        return None
+    checkpoint['size'] = current['size']
+    return checkpoint
+
+
+def checkpoint_behind(checkpoint, log):
+    """Есть ли в логе строки, не вошедшие в контрольную точку."""
+    if not checkpoint['complete']:
+        return True
+    return not log.endswith('.gz') and checkpoint['size'] > checkpoint['offset']
+
+
+# режимы агрегации LogAnalyzer: точные списки значений, они же в компактном массиве
+# или скетч фиксированного размера
+AGGREGATIONS = {
+    'exact': UrlSamples,
+    'compact': CompactSamples,
+    'sketch': UrlSketch,
+}
+
+
+def get_aggregate_path(date):
+    return os.path.join(config['AGGREGATE_DIR'], 'aggregate-{}.json.gz'.format(date.strftime('%Y.%m.%d')))
+
+
+def save_aggregate(path, analyzer, date, sketch=True):
+    """ Атомарно сохраняет агрегат лога за дату date: для каждого URL count,
+        сумму, максимум и гистограмму (UrlSketch), независимо от режима агрегации.
+        С sketch=False сохраняется частичный агрегат в режиме анализатора
+        (для точного слияния логов нескольких хостов, см. merge_partials).
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    aggregate = json.dumps({'version': AGGREGATE_VERSION, 'date': date.strftime('%Y.%m.%d'),
+                            'host': socket.gethostname()}, separators=(',', ':'))
+    state = json.dumps(analyzer.dump_header(sketch=sketch), separators=(',', ':'))
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb') as aggregate_file:
+        # список URL пишется по записи: у SpillingAnalyzer он целиком в память не помещается
+        aggregate_file.write((aggregate[:-1] + ',"state":' + state[:-1] + ',"urls":[').encode('utf-8'))
+        for index, entry in enumerate(analyzer.dump_urls(sketch=sketch)):
+            aggregate_file.write(((',' if index else '') + json.dumps(entry, separators=(',', ':'))).encode('utf-8'))
+        aggregate_file.write(b']}}')
+    os.rename(tmp_path, path)
+
+
+def load_aggregate(path):
+    with gzip.open(path, 'rb') as aggregate_file:
+        aggregate = json.loads(aggregate_file.read().decode('utf-8'))
+    if aggregate.get('version') != AGGREGATE_VERSION:
+        raise ValueError('Unsupported aggregate version in {}'.format(path))
+    return aggregate
+
+
+def store_aggregate(analyzer, log):
+    """Сохраняет дневной агрегат лога, если задан AGGREGATE_DIR."""
+    if config.get('AGGREGATE_DIR'):
+        save_aggregate(get_aggregate_path(log.date), analyzer, log.date)
+
+
+def rollup(date_from, date_to):
+    """ Сводный отчет за даты [date_from, date_to] из дневных агрегатов
+        AGGREGATE_DIR без чтения исходных логов. Возвращает путь отчета или None.
+    """
+    aggregate_dir = config.get('AGGREGATE_DIR')
+    if not aggregate_dir:
+        logging.error('AGGREGATE_DIR is not set in the configuration')
+        return None
+    try:
+        names = sorted(list_files(aggregate_dir))
+    except OSError:
+        logging.error('Aggregate directory {} not found'.format(aggregate_dir))
+        return None
+    analyzer = LogAnalyzer(iter(()), 'sketch')
+    re_aggregate = re.compile(RE_AGGREGATE_NAME)
+    days = 0
+    for name in names:
+        match = re_aggregate.search(name)
+        if match and date_from <= datetime.strptime(match.group('date'), '%Y.%m.%d') <= date_to:
+            analyzer.merge_state(load_aggregate(os.path.join(aggregate_dir, name))['state'])
+            days += 1
+    if not days:
+        logging.info('No aggregates between {:%Y.%m.%d} and {:%Y.%m.%d}'.format(date_from, date_to))
+        return None
+    logging.info('Rolling up {} days'.format(days))
+    report_path = os.path.join(
+        config['REPORT_DIR'],
+        'report-{:%Y.%m.%d}-{:%Y.%m.%d}.html'.format(date_from, date_to)
+    )
+    if report(analyzer.top(config['REPORT_SIZE']), report_path):
+        return report_path
+
+
+def emit_partial(path, log):
+    """ Разбирает лог и сохраняет частичный агрегат в текущем режиме
+        AGGREGATION для последующего слияния с агрегатами других хостов.
+    """
+    analyzer = analyze_log(LogAnalyzer(iter(()), config.get('AGGREGATION', 'exact')), log.path)
+    save_aggregate(path, analyzer, log.date, sketch=False)
+    logging.info('The partial aggregate {} is ready'.format(path))
+
+
+def merge_partials(paths):
+    """ Сливает частичные агрегаты (emit_partial) в указанном порядке и строит
+        отчет. Отчет совпадает с отчетом по логу, склеенному из исходных логов
+        в том же порядке. Возвращает путь отчета или None.
+    """
+    analyzer = None
+    dates = []
+    for path in paths:
+        aggregate = load_aggregate(path)
+        if analyzer is None:
+            analyzer = LogAnalyzer(iter(()), aggregate['state']['aggregation'])
+        analyzer.merge_state(aggregate['state'])
+        dates.append(datetime.strptime(aggregate['date'], '%Y.%m.%d'))
+    if analyzer is None:
+        return None
+    if min(dates) == max(dates):
+        name = 'report-{:%Y.%m.%d}.html'.format(dates[0])
+    else:
+        name = 'report-{:%Y.%m.%d}-{:%Y.%m.%d}.html'.format(min(dates), max(dates))
+    report_path = os.path.join(config['REPORT_DIR'], name)
+    if report(analyzer.top(config['REPORT_SIZE']), report_path):
+        return report_path
+
+
+LogFile = namedtuple('LogFile', ('path', 'date'))
+
+
+def list_files(path):
+    """Имена файлов каталога за один проход os.scandir (без него - os.listdir)."""
+    if scandir:
+        return [entry.name for entry in scandir(path) if entry.is_file()]
+    return os.listdir(path)
+
+
+def scan_logs(path):
+    """Все логи интерфейса в каталоге path в порядке обхода каталога."""
+    result = []
     re_log = re.compile(RE_LOG_NAME)
     if os.path.exists(path):
-        for name in os.listdir(path):
+        for name in list_files(path):
             date = re_log.search(name)
             if date:
-                date = int(date.groupdict()['date'])
-                if max < date:
-                    max = date
-                    log_file = name
-    if max:
-        LastLog = namedtuple('LastLog', ('path', 'date'))
-        date = str(max)
-        dt = datetime.strptime(date, '%Y%m%d')
-        result = LastLog(os.path.abspath(os.path.join(path, log_file)), dt)
+                try:
+                    date = datetime.strptime(date.groupdict()['date'], '%Y%m%d')
+                except ValueError:
+                    continue
+                result.append(LogFile(os.path.abspath(os.path.join(path, name)), date))
+    return result
+
+
+def get_last_log(path):
+    result = None
+    for log in scan_logs(path):
+        if not result or result.date < log.date:
+            result = log
     return result
 
 
+def get_report_path(log):
+    return os.path.join(
+        config['REPORT_DIR'],
+        'report-{}.html'.format(log.date.strftime('%Y.%m.%d'))
+    )
+
+
+def process_log(log):
+    """Строит отчет по одному логу; выполняется в процессе пула --backfill."""
+    try:
+        analyzer = make_analyzer(config.get('AGGREGATION', 'exact'))
+        try:
+            # процессы пула не могут порождать свой пул, поэтому лог разбирается последовательно
+            analyze_log(analyzer, log.path, workers=1)
+            store_aggregate(analyzer, log)
+            data = analyzer.top(config['REPORT_SIZE'])
+            return report(data, get_report_path(log), series=report_series(analyzer, data))
+        finally:
+            analyzer.close()
+    except Exception:
+        logging.exception('Failed to process {}'.format(log.path))
+        return False
+
+
+def backfill():
+    """ Строит отчеты по всем логам LOG_DIR, для которых их еще нет, в пуле
+        из BACKFILL_WORKERS процессов (по умолчанию по числу ядер).
+        Возвращает True, если все отчеты построены.
+    """
+    logs = []
+    dates = set()
+    for log in sorted(scan_logs(config['LOG_DIR']), key=lambda log: log.date):
+        if log.date not in dates and not os.path.exists(get_report_path(log)):
+            dates.add(log.date)
+            logs.append(log)
+    if not logs:
+        logging.info('Nothing to backfill')
+        return True
+    logging.info('Backfilling {} logs'.format(len(logs)))
+    pool = multiprocessing.Pool(min(config.get('BACKFILL_WORKERS', multiprocessing.cpu_count()), len(logs)))
+    try:
+        results = pool.map(process_log, logs)
+    finally:
+        pool.close()
+        pool.join()
+    return all(results)
+
+
 def open_config(config):
     config = config or CONFIG
     if os.path.exists(config):
@@ -147,21 +2184,180 @@ def open_config(config):
         return {}
 
 
-def report(data, path):
+_templates = {}
+
+
+def load_template(path):
+    """ Шаблон отчета, разделенный по PLACEHOLDER и PAGES_PLACEHOLDER:
+        (начало, середина, конец). Если в шаблоне нет PAGES_PLACEHOLDER,
+        середина - None. Разделенный шаблон кэшируется до изменения файла.
+    """
+    mtime = os.path.getmtime(path)
+    cached = _templates.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path) as template:
+        head, placeholder, tail = template.read().partition(PLACEHOLDER)
+    if not placeholder:
+        raise KeyError('{} not found in {}'.format(PLACEHOLDER, path))
+    middle, placeholder, tail = tail.partition(PAGES_PLACEHOLDER)
+    parts = (head, middle, tail) if placeholder else (head, None, middle)
+    _templates[path] = (mtime, parts)
+    return parts
+
+
+def write_rows(out, rows):
+    """Пишет строки отчета JSON-массивом, как json.dumps(list(rows))."""
+    out.write('[')
+    for i, row in enumerate(rows):
+        if i:
+            out.write(', ')
+        out.write(json.dumps(row))
+    out.write(']')
+
+
+def write_pages(rows, path, page_size):
+    """ Раскладывает строки отчета по страницам page-N.js в каталоге path;
+        страница вызывает reportPage(N, rows). Возвращает описание страниц для шаблона.
+    """
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    count = 1
+    while True:
+        page = list(itertools.islice(rows, page_size))
+        if not page:
+            break
+        with open(os.path.join(tmp_path, 'page-{}.js'.format(count)), 'w') as page_file:
+            page_file.write('reportPage({}, '.format(count))
+            write_rows(page_file, page)
+            page_file.write(');\n')
+        count += 1
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return {'base': os.path.basename(path) + '/', 'count': count}
+
+
+def write_series(series, path):
+    """ Пишет ряды по времени (TimeSeries.export) в path + '.json' для
+        скриптов и в path + '.js' для отчета. Возвращает имя .js-файла.
+    """
+    for ext, prefix, suffix in (('.json', '', '\n'), ('.js', 'reportSeries(', ');\n')):
+        tmp_path = path + ext + '.tmp'
+        with open(tmp_path, 'w') as series_file:
+            series_file.write(prefix)
+            json.dump(series, series_file)
+            series_file.write(suffix)
+        os.rename(tmp_path, path + ext)
+    return os.path.basename(path) + '.js'
+
+
+def report(data, path, page_size=None, series=None):
+    """ Пишет отчет потоково: начало шаблона, строки таблицы по одной, конец
+        шаблона. Запись идет во временный файл, который затем атомарно
+        переименовывается, поэтому недописанный отчет не появляется под именем path.
+        При page_size (по умолчанию REPORT_PAGE_SIZE) в отчет встраивается только
+        первая страница строк, остальные пишутся в каталог report-*.data рядом
+        с отчетом и подгружаются страницей по мере прокрутки. Ряды по времени
+        series (TimeSeries.export) пишутся в report-*.series.json и .js рядом
+        с отчетом; отчет подгружает их, если в шаблоне есть SERIES_PLACEHOLDER.
+    """
+    page_size = page_size or config.get('REPORT_PAGE_SIZE')
+    tmp_path = path + '.tmp'
     try:
         if not os.path.exists(os.path.dirname(path)):
             os.makedirs(os.path.dirname(path))
-        with open(config['REPORT_TEMPLATE']) as template, open(path, 'w') as report:
+        head, middle, tail = load_template(config['REPORT_TEMPLATE'])
+        if page_size and middle is None:
+            logging.error('{} not found in the template, pages are disabled'.format(PAGES_PLACEHOLDER))
+            page_size = None
+        rows = iter(data)
+        series_script = write_series(series, os.path.splitext(path)[0] + '.series') if series else None
+        head, middle, tail = [part and part.replace(SERIES_PLACEHOLDER, json.dumps(series_script))
+                              for part in (head, middle, tail)]
+        with open(tmp_path, 'w') as report:
             logging.info('Reporting...')
-            report.write(
-                template.read().replace(
-                    PLACEHOLDER, json.dumps(data)
-                )
-            )
-            logging.info('The report {} is ready'.format(report.name))
-    except (IOError, KeyError):
+            report.write(head)
+            write_rows(report, itertools.islice(rows, page_size) if page_size else rows)
+            if middle is not None:
+                report.write(middle)
+                pages = write_pages(rows, os.path.splitext(path)[0] + '.data', page_size) if page_size else None
+                report.write(json.dumps(pages))
+            report.write(tail)
+        os.rename(tmp_path, path)
+        logging.info('The report {} is ready'.format(path))
+        return True
+    except (IOError, OSError, KeyError):
         logging.error('Report error')
-        return
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+def cpu_time():
+    """Процессорное время (user + system) процесса и завершившихся дочерних процессов."""
+    return sum(os.times()[:4])
+
+
+def peak_rss():
+    """ Пиковый RSS процесса и его дочерних процессов (в КБ на Linux, в байтах
+        на macOS) или None, если модуля resource нет.
+    """
+    if resource is None:
+        return None
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+class RunMetrics(object):
+    """ Метрики запуска для мониторинга: время (wall и CPU) по фазам, число
+        строк, байт и ошибок парсинга, скорость и пиковый RSS.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Замеряет фазу name; в отданный словарь можно дописать lines, bytes
+            и errors, по ним считаются lines_per_sec и mb_per_sec.
+        """
+        phase = self.phases[name] = {}
+        wall, cpu = time.time(), cpu_time()
+        try:
+            yield phase
+        finally:
+            phase['wall'] = time.time() - wall
+            phase['cpu'] = cpu_time() - cpu
+            if phase['wall']:
+                if 'lines' in phase:
+                    phase['lines_per_sec'] = phase['lines'] / phase['wall']
+                if 'bytes' in phase:
+                    phase['mb_per_sec'] = phase['bytes'] / 1048576.0 / phase['wall']
+            logging.info('{}: {:.3f}s wall, {:.3f}s CPU'.format(name, phase['wall'], phase['cpu']))
+
+    def progress(self, stats, started):
+        """Пишет в лог прогресс разбора по словарю stats из log_generator."""
+        elapsed = time.time() - started
+        logging.info('Processed {} lines ({:.0f} lines/s), {} parse errors, peak RSS {}'.format(
+            stats['lines'], stats['lines'] / elapsed if elapsed else 0, stats['errors'], peak_rss()))
+
+    def save(self, path, **info):
+        """Атомарно пишет метрики в JSON вместе с дополнительными полями info."""
+        metrics = dict(info, started=self.started, finished=time.time(), peak_rss=peak_rss(), phases=self.phases)
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as metrics_file:
+                json.dump(metrics, metrics_file, indent=2, sort_keys=True)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            logging.error('Metrics not saved')
+
+
+ANALYZE_TIMINGS = ('decompress_wall', 'decompress_cpu', 'decompress_child_cpu', 'parse_wall', 'aggregate_wall')
 
 
 def write_ts():
@@ -172,34 +2368,134 @@ def write_ts():
         logging.error('Timestamp not created')
 
 
+def sample_rate(value):
+    """Тип аргумента --sample: доля строк в (0, 1]."""
+    rate = float(value)
+    if not 0 < rate <= 1:
+        raise argparse.ArgumentTypeError('sample rate must be in (0, 1], got {}'.format(value))
+    return rate
+
+
 def main():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('--config', help='path to config file', default='/usr/local/etc/log_analyzer.conf')
+    arg_parser.add_argument('--backfill', action='store_true', help='build reports for all unreported logs')
+    arg_parser.add_argument('--rollup', nargs=2, metavar=('FROM', 'TO'),
+                            type=lambda date: datetime.strptime(date, '%Y%m%d'),
+                            help='build a report for dates FROM..TO (YYYYMMDD) from stored daily aggregates')
+    arg_parser.add_argument('--emit-partial', metavar='PATH',
+                            help='parse the last log and save its partial aggregate to PATH')
+    arg_parser.add_argument('--merge', nargs='+', metavar='PARTIAL',
+                            help='build a report from partial aggregates of several hosts')
+    arg_parser.add_argument('--follow', action='store_true',
+                            help='tail the current log and refresh REPORT_DIR/report-live.html periodically')
+    arg_parser.add_argument('--sample', nargs='?', type=sample_rate, const=SAMPLE_RATE, metavar='RATE',
+                            help='estimate the report of the last log from a random share of it (default 0.01)')
     args = arg_parser.parse_args()
     conf = open_config(args.config)
     config.update(conf)
     logging.basicConfig(filename=config.get('SCRIPT_LOG', ''), level=logging.INFO,
                         format='[%(asctime)s] %(levelname)s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
     logging.info('Start logging')
+    if args.backfill:
+        if backfill():
+            write_ts()
+        logging.info('End logging')
+        return
+    if args.rollup:
+        rollup(*args.rollup)
+        logging.info('End logging')
+        return
+    if args.merge:
+        merge_partials(args.merge)
+        logging.info('End logging')
+        return
+    if args.follow:
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        try:
+            follow(config.get('FOLLOW_LOG', os.path.join(config['LOG_DIR'], 'nginx-access-ui.log')),
+                   os.path.join(config['REPORT_DIR'], 'report-live.html'),
+                   config.get('FOLLOW_INTERVAL', FOLLOW_INTERVAL), stop=stop)
+        except KeyboardInterrupt:
+            pass
+        logging.info('End logging')
+        return
+
     last_log = get_last_log(config['LOG_DIR'])
     if not last_log:
         logging.info('Log file not found')
         return
 
-    report_path = os.path.join(
-        config['REPORT_DIR'],
-        'report-{}.html'.format(last_log.date.strftime('%Y.%m.%d'))
-    )
+    if args.emit_partial:
+        emit_partial(args.emit_partial, last_log)
+        logging.info('End logging')
+        return
 
-    if not os.path.exists(report_path):
-        if not os.path.exists(config['REPORT_DIR']):
-            os.makedirs(config['REPORT_DIR'])
-        analyzer = LogAnalyzer(log_generator(last_log.path, log_parser, RE_LOG_LINE))
-        data = [item for item in analyzer.calc()]
-        data = sorted(data, key=lambda d: d['time_sum'], reverse=True)
-        report(data[:config['REPORT_SIZE']], report_path)
-        write_ts()
+    if args.sample:
+        analyzer = sample_log(last_log.path, args.sample)
+        report(analyzer.top(config['REPORT_SIZE']), os.path.splitext(get_report_path(last_log))[0] + '.sample.html')
         logging.info('End logging')
+        return
+
+    report_path = get_report_path(last_log)
+
+    # с ограничением памяти состояние целиком в контрольную точку не пишется
+    spilling = config.get('SPILL_MAX_KEYS') or config.get('SPILL_MAX_MB')
+    checkpoint_enabled = config.get('CHECKPOINT') and 'TS_FILE' in config and not spilling
+    checkpoint_path = ts_sibling('.checkpoint') if checkpoint_enabled else None
+    checkpoint = load_checkpoint(checkpoint_path, last_log.path, state=False) if checkpoint_path else None
+    if os.path.exists(report_path) and not (checkpoint and checkpoint_behind(checkpoint, last_log.path)):
+        return
+    if checkpoint:
+        checkpoint = load_checkpoint(checkpoint_path, last_log.path)
+
+    if not os.path.exists(config['REPORT_DIR']):
+        os.makedirs(config['REPORT_DIR'])
+    analyzer = make_analyzer(config.get('AGGREGATION', 'exact'))
+    try:
+        start, lines = 0, 0
+        if checkpoint:
+            logging.info('Resuming from offset {} of {}'.format(checkpoint['offset'], last_log.path))
+            analyzer.merge_state(checkpoint['state'])
+            start, lines = checkpoint['offset'], checkpoint['lines']
+        stats = {}
+        metrics = RunMetrics()
+        analyze_started = time.time()
+
+        checkpoint_every = config.get('CHECKPOINT_EVERY', CHECKPOINT_EVERY)
+        next_checkpoint = [checkpoint_every]
+        # недописанная последняя строка не попадает в контрольную точку: её дочитает следующий запуск
+        end = last_line_end(last_log.path) if checkpoint_path and not last_log.path.endswith('.gz') else None
+
+        def on_progress(stats):
+            metrics.progress(stats, analyze_started)
+            if checkpoint_path and stats['lines'] >= next_checkpoint[0]:
+                save_checkpoint(checkpoint_path, last_log.path, analyzer, stats['offset'], lines + stats['lines'])
+                next_checkpoint[0] = stats['lines'] + checkpoint_every
+
+        with metrics.phase('analyze') as phase:
+            analyze_log(analyzer, last_log.path, start, stats, on_progress, end=end)
+            phase.update(lines=stats['lines'], errors=stats['errors'], bytes=stats['offset'] - start)
+            # раздельные замеры: распаковка gzip и оценка разбора и агрегации (без WORKERS)
+            phase.update((key, stats[key]) for key in ANALYZE_TIMINGS if key in stats)
+        with metrics.phase('store_aggregate'):
+            store_aggregate(analyzer, last_log)
+        with metrics.phase('top') as phase:
+            data = analyzer.top(config['REPORT_SIZE'])
+            phase['urls'] = len(analyzer.urls)
+        with metrics.phase('report') as phase:
+            phase['rows'] = len(data)
+            reported = report(data, report_path, series=report_series(analyzer, data))
+        if checkpoint_path:
+            save_checkpoint(checkpoint_path, last_log.path, analyzer, stats['offset'], lines + stats['lines'], True)
+    finally:
+        analyzer.close()
+    if 'TS_FILE' in config:
+        metrics.save(ts_sibling('.metrics.json'), log=last_log.path, start_offset=start,
+                     aggregation=analyzer.aggregation, report=report_path if reported else None)
+    write_ts()
+    logging.info('End logging')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+import unittest
+
+try:
+    import deco
+except SyntaxError:
+    # deco.py is written for Python 2
+    deco = None
+
+
+class FakeClock(object):
+
+    def __init__(self, *times):
+        self.times = list(times)
+
+    def time(self):
+        return self.times.pop(0)
+
+
+@unittest.skipIf(deco is None, 'deco.py requires Python 2')
+class MemoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def square(self, n):
+        self.calls.append(n)
+        return n * n
+
+    def test_lru_eviction(self):
+        square = deco.memo(maxsize=2)(self.square)
+        for n in (1, 2, 1, 3, 1, 2):
+            self.assertEqual(square(n), n * n)
+        # 1 is used again before 3 comes, so 3 evicts 2; then 2 evicts 3, the least recently used
+        self.assertEqual(self.calls, [1, 2, 3, 2])
+        self.assertEqual(square.cache_info(), deco.CacheInfo(hits=2, misses=4, evictions=2, maxsize=2, currsize=2))
+        self.assertEqual(square(1), 1)
+        self.assertEqual(self.calls, [1, 2, 3, 2])
+
+    def test_unbounded(self):
+        square = deco.memo(self.square)
+        for n in range(5) * 2:
+            square(n)
+        self.assertEqual(self.calls, range(5))
+        self.assertEqual(square.cache_info(), deco.CacheInfo(hits=5, misses=5, evictions=0, maxsize=None, currsize=5))
+
+    def test_unhashable(self):
+        total = deco.memo(maxsize=4)(lambda items: self.calls.append(items) or sum(items))
+        self.assertEqual(total([1, 2]), 3)
+        self.assertEqual(total([1, 2]), 3)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(total.cache_info(), deco.CacheInfo(hits=0, misses=2, evictions=0, maxsize=4, currsize=0))
+
+    def test_cache_clear(self):
+        square = deco.memo(maxsize=2)(self.square)
+        square(1)
+        square(1)
+        square.cache_clear()
+        self.assertEqual(square.cache_info(), deco.CacheInfo(hits=0, misses=0, evictions=0, maxsize=2, currsize=0))
+        square(1)
+        self.assertEqual(self.calls, [1, 1])
+
+
+@unittest.skipIf(deco is None, 'deco.py requires Python 2')
+class TimedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = deco.time
+
+    def tearDown(self):
+        deco.time = self.time
+
+    def test_histogram(self):
+        # calls of 0.5 us, 3 us and 1000 us
+        deco.time = FakeClock(0.0, 0.0000005, 1.0, 1.000003, 2.0, 2.001)
+        identity = deco.timed(lambda n: n)
+        for n in range(3):
+            self.assertEqual(identity(n), n)
+        self.assertEqual([(bucket, count) for bucket, count in enumerate(identity.histogram) if count],
+                         [(0, 1), (2, 1), (10, 1)])
+        stats = identity.stats()
+        self.assertEqual(stats['calls'], 3)
+        self.assertAlmostEqual(stats['total'], 0.0010035)
+        self.assertAlmostEqual(stats['max'], 0.001)
+        self.assertEqual((stats['p50'], stats['p99']), (0.000004, 0.001024))
+
+    def test_exception(self):
+        deco.time = FakeClock(0.0, 0.5)
+
+        @deco.timed
+        def fail():
+            raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(fail.calls, 1)
+        self.assertEqual(fail.max, 0.5)
+
+
+@unittest.skipIf(deco is None, 'deco.py requires Python 2')
+class SampledTest(unittest.TestCase):
+
+    def test_every_nth(self):
+        logged = []
+        half = deco.sampled(3, log=logged.append)(lambda n: n / 2.0)
+        for n in range(10):
+            self.assertEqual(half(n), n / 2.0)
+        self.assertEqual([(args, res) for args, res, _ in half.samples], [((2,), 1.0), ((5,), 2.5), ((8,), 4.0)])
+        self.assertEqual(len(logged), 3)
+        self.assertTrue(logged[0].startswith('<lambda>(2) == 1.0 in '))
+
+    def test_keep(self):
+        identity = deco.sampled(1, keep=2)(lambda n: n)
+        for n in range(5):
+            identity(n)
+        self.assertEqual([res for _, res, _ in identity.samples], [3, 4])
+
+    def test_exception(self):
+        inverse = deco.sampled(2)(lambda n: 1.0 / n)
+        inverse(1)
+        self.assertRaises(ZeroDivisionError, inverse, 0)
+        self.assertEqual(len(inverse.samples), 1)
+        self.assertIsInstance(inverse.samples[0][1], ZeroDivisionError)
+
+
+if __name__ == '__main__':
+    unittest.main()
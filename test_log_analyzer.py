@@ -1,11 +1,49 @@
 import os
+import sys
+import json
+import gzip
+import pickle
+import shutil
+import time
+import tempfile
+import threading
+from datetime import datetime
 import unittest
 
+import benchmark
 import log_analyzer
 from log_analyzer import log_parser
 from log_analyzer import LogAnalyzer
 from log_analyzer import RE_LOG_LINE
 from log_analyzer import log_generator
+from log_analyzer import LogFormatParser
+from log_analyzer import LatencyHistogram
+from log_analyzer import split_log
+from log_analyzer import read_log
+from log_analyzer import parallel_analyzer
+from log_analyzer import read_gzip
+from log_analyzer import UrlNormalizer
+from log_analyzer import normalize_urls
+from log_analyzer import analyze_log
+from log_analyzer import save_checkpoint
+from log_analyzer import load_checkpoint
+from log_analyzer import checkpoint_behind
+from log_analyzer import scan_logs
+from log_analyzer import save_aggregate
+from log_analyzer import load_aggregate
+from log_analyzer import rollup
+from log_analyzer import emit_partial
+from log_analyzer import merge_partials
+from log_analyzer import sample_blocks
+from log_analyzer import sample_log
+from log_analyzer import SpillingAnalyzer
+from log_analyzer import TimeSeries
+from log_analyzer import LiveAnalyzer
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 
 
 def cases(test_cases):
@@ -19,6 +57,33 @@ def cases(test_cases):
     return decorator
 
 
+class TmpDirTestCase(unittest.TestCase):
+    """ Base for tests that need a temporary directory (self.tmp) or change
+        log_analyzer.config: both are restored in tearDown.
+    """
+
+    def setUp(self):
+        self.config = dict(log_analyzer.config)
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        log_analyzer.config.clear()
+        log_analyzer.config.update(self.config)
+        shutil.rmtree(self.tmp)
+
+    def run_main(self, *args, **settings):
+        """Runs log_analyzer.main() with command line args and a config file holding settings."""
+        conf_path = os.path.join(self.tmp, 'log_analyzer.conf')
+        with open(conf_path, 'w') as conf:
+            json.dump(settings, conf)
+        argv = sys.argv
+        sys.argv = ['log_analyzer.py', '--config', conf_path] + list(args)
+        try:
+            log_analyzer.main()
+        finally:
+            sys.argv = argv
+
+
 class LogParserTest(unittest.TestCase):
 
     def setUp(self):
@@ -69,6 +134,84 @@ class LogParserTest(unittest.TestCase):
         self.assertEquals(item, args)
 
 
+class LogFormatParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = LogFormatParser()
+
+    def test_same_as_log_parser(self):
+        regex_parser = LogFormatParser()
+        regex_parser._fast = None
+        with open('./test/nginx-access-ui.log-20170630.log') as log:
+            for line in log:
+                expected = log_parser(RE_LOG_LINE, line)
+                self.assertEqual(self.parser(line), expected)
+                self.assertEqual(regex_parser(line), expected)
+
+    @cases([('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-"'
+             ' "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759"'
+             ' "dc7161be3" 0.390\n',
+             ('GET', '/api/v2/banner/25019354', '200', '29/Jun/2017:03:50:22 +0300', '0.390')),
+            ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "POST /api/1/photo/ HTTP/1.0" 404 0 "-" "-" "-" "-" "-"'
+             ' 12.001\n',
+             ('POST', '/api/1/photo/', '404', '29/Jun/2017:03:50:22 +0300', '12.001'))])
+    def test_extra_fields(self, args):
+        parser = LogFormatParser(fields=('method', 'url', 'status', 'time_local', 'request_time'))
+        self.assertEqual(parser(args[0]), args[1])
+        self.assertEqual(parser.parse_regex(args[0]), args[1])
+
+    @cases(['',
+            'garbage\n',
+            '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" "-"'
+            ' "-" "-" "-" -\n'])
+    def test_malformed(self, line):
+        self.assertIsNone(self.parser(line))
+
+    def test_unknown_field(self):
+        self.assertRaises(ValueError, LogFormatParser, fields=('url', 'upstream_time'))
+
+
+class MmapIngestTest(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.log = os.path.join(self.tmp, 'nginx-access-ui.log-20170630.log')
+        with open('./test/nginx-access-ui.log-20170630.log', 'rb') as log:
+            lines = [line.rstrip(b'\n') + b'\n' for line in log]
+        # a quote before the request does not fit bytes_regex, the parser itself handles the line
+        quoted = lines[0].replace(b'-  -', b'- "x -', 1)
+        with open(self.log, 'wb') as log:
+            log.writelines(lines[:100] + [b'garbage\n', quoted, b'\n'] + lines[100:])
+            log.write(lines[0].rstrip(b'\n'))
+        self.text_parser = LogFormatParser()
+        self.text_parser.bytes_regex = None
+
+    def items(self, parser, **kwargs):
+        return [item and (item[0], float(item[1])) for item in log_generator(self.log, parser, **kwargs)]
+
+    @cases([(0, None), (0, 5000), (5000, 40000), (40000, None)])
+    def test_same_as_text(self, args):
+        with open(self.log, 'rb') as log:
+            start, end = log_analyzer.line_start(log, args[0]), args[1]
+        mmap_stats, text_stats = {}, {}
+        self.assertEqual(self.items(LogFormatParser(), start=start, end=end, stats=mmap_stats),
+                         self.items(self.text_parser, start=start, end=end, stats=text_stats))
+        self.assertEqual(mmap_stats, text_stats)
+
+    def test_fallback(self):
+        items = self.items(LogFormatParser())
+        self.assertEqual(items[100:103], [None, ('/api/v2/banner/24824230', 0.143), None])
+        self.assertEqual(items[-1], items[0])
+
+    def test_progress(self):
+        offsets = []
+        list(log_generator(self.log, LogFormatParser(), progress_every=50,
+                           on_progress=lambda stats: offsets.append((stats['lines'], stats['offset']))))
+        with open(self.log, 'rb') as log:
+            lines = log.readlines()
+        self.assertEqual(offsets, [(n, len(b''.join(lines[:n]))) for n in range(50, len(lines), 50)])
+
+
 class LogAnalyzerTest(unittest.TestCase):
 
     def setUp(self):
@@ -84,6 +227,14 @@ class LogAnalyzerTest(unittest.TestCase):
         self.log_generator2.close()
         self.calc_generator.close()
 
+    def test_all_time_exact(self):
+        expected = 0
+        for item in log_generator('./test/nginx-access-ui.log-20170630.log', LogFormatParser()):
+            if item:
+                expected += int(float(item[1]) * 1000 + 0.5)
+        self.assertEqual(self.true_analyzer.all_ms, expected)
+        self.assertEqual(self.true_analyzer.all_time, expected / 1000.0)
+
     @cases([([0.9, 1.2, 1.23, 1.4], 1.215),
             ([0.0], 0.0),
             ([0.3], 0.3),
@@ -120,33 +271,33 @@ class LogAnalyzerTest(unittest.TestCase):
         self.assertAlmostEqual(kwargs['time_perc'], time_perc, delta=0.001)
         self.assertAlmostEqual(kwargs['count_perc'], count_perc, delta=0.001)
 
-    @cases([{'count': 1, 'time_avg': 0.145, 'time_max': 0.145, 'time_sum': 0.145, 'url': '/api/v2/banner/1717161',
-             'time_med': 0.145, 'time_perc': 0.07561416957390106, 'count_perc': 0.29069767441860467},
-            {'count': 1, 'time_avg': 0.183, 'time_max': 0.183, 'time_sum': 0.183, 'url': '/api/1/campaigns/?id=7952462',
-             'time_med': 0.183, 'time_perc': 0.0954302967725786, 'count_perc': 0.29069767441860467},
-            {'count': 1, 'time_avg': 0.386, 'time_max': 0.386, 'time_sum': 0.386,
-             'url': '/api/v2/group/7843268/banners', 'time_med': 0.386, 'time_perc': 0.2012901341760401,
-             'count_perc': 0.29069767441860467},
-            {'count': 1, 'time_avg': 0.142, 'time_max': 0.142, 'time_sum': 0.142, 'url': '/api/v2/banner/16168711',
-             'time_med': 0.142, 'time_perc': 0.07404973847926863, 'count_perc': 0.29069767441860467},
-            {'count': 1, 'time_avg': 0.068, 'time_max': 0.068, 'time_sum': 0.068,
-             'url': '/api/v2/banner/26624919/statistic/?date_from=2017-06-29&date_to=2017-06-29', 'time_med': 0.068,
-             'time_perc': 0.03546043814500188, 'count_perc': 0.29069767441860467},
-            {'count': 1, 'time_avg': 0.587, 'time_max': 0.587, 'time_sum': 0.587,
-             'url': '/api/v2/group/7861864/banners', 'time_med': 0.587, 'time_perc': 0.3061070175164133,
+    @cases([{'count': 1, 'time_avg': 0.143, 'time_max': 0.143, 'time_sum': 0.143, 'url': '/api/v2/banner/24824230',
+             'time_med': 0.143, 'time_perc': 0.07453040632101231, 'count_perc': 0.29069767441860467},
+            {'count': 25, 'time_avg': 0.0009200000000000006, 'time_max': 0.001, 'time_sum': 0.023000000000000013,
+             'url': '/export/appinstall_raw/2017-06-30/', 'time_med': 0.001, 'time_perc': 0.011987408009673314,
+             'count_perc': 7.267441860465116},
+            {'count': 1, 'time_avg': 0.07, 'time_max': 0.07, 'time_sum': 0.07,
+             'url': '/api/v2/group/6646605/statistic/sites/?date_type=day&date_from=2017-06-29&date_to=2017-06-29',
+             'time_med': 0.07, 'time_perc': 0.03648341568161442, 'count_perc': 0.29069767441860467},
+            {'count': 1, 'time_avg': 1.36, 'time_max': 1.36, 'time_sum': 1.36, 'url': '/api/v2/banner/26736849',
+             'time_med': 1.36, 'time_perc': 0.7088206475285087, 'count_perc': 0.29069767441860467},
+            {'count': 1, 'time_avg': 0.169, 'time_max': 0.169, 'time_sum': 0.169,
+             'url': '/api/1/banners/?campaign=434094', 'time_med': 0.169, 'time_perc': 0.0880813892884691,
              'count_perc': 0.29069767441860467},
-            {'count': 1, 'time_avg': 0.061, 'time_max': 0.061, 'time_sum': 0.061,
-             'url': '/api/v2/group/6812420/statistic/sites/?date_type=day&date_from=2017-06-29&date_to=2017-06-29',
-             'time_med': 0.061, 'time_perc': 0.03181009892419286, 'count_perc': 0.29069767441860467},
-            {'count': 1, 'time_avg': 1.991, 'time_max': 1.991, 'time_sum': 1.991, 'url': '/api/v2/banner/21542368',
-             'time_med': 1.991, 'time_perc': 1.0382607698043935, 'count_perc': 0.29069767441860467},
-            {'count': 1, 'time_avg': 0.178, 'time_max': 0.178, 'time_sum': 0.178,
-             'url': '/api/v2/internal/revenue_share/service/276/partner/1114631/statistic/v2?date_from=2017-06-23'
-                    '&date_to=2017-06-29&date_type=day', 'time_med': 0.178, 'time_perc': 0.09282291161485787,
+            {'count': 1, 'time_avg': 0.1, 'time_max': 0.1, 'time_sum': 0.1,
+             'url': '/api/v2/banner/22211801/statistic/?date_from=2017-06-29&date_to=2017-06-29', 'time_med': 0.1,
+             'time_perc': 0.052119165259449166, 'count_perc': 0.29069767441860467},
+            {'count': 1, 'time_avg': 1.417, 'time_max': 1.417, 'time_sum': 1.417, 'url': '/api/v2/banner/26736214',
+             'time_med': 1.417, 'time_perc': 0.7385285717263947, 'count_perc': 0.29069767441860467},
+            {'count': 1, 'time_avg': 0.163, 'time_max': 0.163, 'time_sum': 0.163, 'url': '/api/v2/banner/227223',
+             'time_med': 0.163, 'time_perc': 0.08495423937290214, 'count_perc': 0.29069767441860467},
+            {'count': 1, 'time_avg': 0.156, 'time_max': 0.156, 'time_sum': 0.156,
+             'url': '/api/v2/internal/revenue_share/service/276/partner/545765/statistic/v2?date_from=2017-06-23'
+                    '&date_to=2017-06-29&date_type=day', 'time_med': 0.156, 'time_perc': 0.08130589780474069,
              'count_perc': 0.29069767441860467},
-            {'count': 1, 'time_avg': 0.096, 'time_max': 0.096, 'time_sum': 0.096,
-             'url': '/api/v2/group/7181748/statistic/sites/?date_type=day&date_from=2017-06-29&date_to=2017-06-29',
-             'time_med': 0.096, 'time_perc': 0.050061795028237946, 'count_perc': 0.29069767441860467}])
+            {'count': 1, 'time_avg': 0.163, 'time_max': 0.163, 'time_sum': 0.163,
+             'url': '/api/1/banners/?campaign=451660', 'time_med': 0.163, 'time_perc': 0.08495423937290214,
+             'count_perc': 0.29069767441860467}])
     def test_analyzer(self, kwargs):
         data = next(self.calc_generator)
         self.assertEqual(data['count'], kwargs['count'])
@@ -158,6 +309,14 @@ class LogAnalyzerTest(unittest.TestCase):
         self.assertAlmostEqual(data['time_perc'], kwargs['time_perc'], delta=0.001)
         self.assertAlmostEqual(data['count_perc'], kwargs['count_perc'], delta=0.001)
 
+    @cases([(1, 'exact'), (10, 'exact'), (1000, 'exact'), (10, 'sketch')])
+    def test_top(self, args):
+        size, aggregation = args
+        log = './test/nginx-access-ui.log-20170630.log'
+        expected = sorted(LogAnalyzer(log_generator(log, LogFormatParser()), aggregation).calc(),
+                          key=lambda d: d['time_sum'], reverse=True)[:size]
+        self.assertEqual(LogAnalyzer(log_generator(log, LogFormatParser()), aggregation).top(size), expected)
+
     def test_get_last_log(self):
         path = log_analyzer.get_last_log('./test')[0]
         name = path.split(os.path.sep)[-1]
@@ -169,3 +328,830 @@ class LogAnalyzerTest(unittest.TestCase):
             ])
     def test_open_config(self, args):
         self.assertEqual(log_analyzer.open_config(args[0]), args[1])
+
+
+class SketchAggregationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.exact = LogAnalyzer(log_generator('./test/nginx-access-ui.log-20170630.log', LogFormatParser()))
+        self.sketch = LogAnalyzer(log_generator('./test/nginx-access-ui.log-20170630.log', LogFormatParser()),
+                                  aggregation='sketch')
+        self.exact.get_data()
+        self.sketch.get_data()
+
+    def test_exact_totals(self):
+        self.assertEqual(self.sketch.all_count, self.exact.all_count)
+        self.assertEqual(self.sketch.all_time, self.exact.all_time)
+        for url, samples in self.exact.time_sum_buf.items():
+            sketch = self.sketch.time_sum_buf[url]
+            self.assertEqual(len(sketch), len(samples))
+            self.assertEqual(sketch.total(), sum(int(round(value * 1000)) for value in samples) / 1000.0)
+            self.assertAlmostEqual(sketch.total(), sum(samples))
+            self.assertEqual(sketch.time_max, max(samples))
+
+    def test_quantile_error_bound(self):
+        accuracy = LatencyHistogram.ACCURACY
+        for url, samples in self.exact.time_sum_buf.items():
+            summary = self.sketch.time_sum_buf[url].summary()
+            samples = sorted(samples)
+            for name, q in (('time_med', 0.5), ('time_p95', 0.95), ('time_p99', 0.99)):
+                exact = samples[int(round(q * (len(samples) - 1)))]
+                self.assertAlmostEqual(summary[name], exact, delta=exact * accuracy + 1e-9)
+
+    def test_merge(self):
+        first, second = LatencyHistogram(), LatencyHistogram()
+        for value in (0.0, 0.1, 0.2):
+            first.add(value)
+        for value in (0.3, 1.5):
+            second.add(value)
+        first.merge(second)
+        self.assertEqual(first.zeros, 1)
+        self.assertAlmostEqual(first.quantile(0.5, 5), 0.2, delta=0.2 * LatencyHistogram.ACCURACY)
+        self.assertAlmostEqual(first.quantile(1.0, 5), 1.5, delta=1.5 * LatencyHistogram.ACCURACY)
+
+    def test_unknown_aggregation(self):
+        self.assertRaises(ValueError, LogAnalyzer, None, 'unknown')
+
+
+class CompactAggregationTest(unittest.TestCase):
+
+    log = './test/nginx-access-ui.log-20170630.log'
+
+    def test_same_as_exact(self):
+        exact = LogAnalyzer(log_generator(self.log, LogFormatParser()))
+        compact = LogAnalyzer(log_generator(self.log, LogFormatParser()), 'compact')
+        self.assertEqual(list(compact.calc()), list(exact.calc()))
+        self.assertEqual(compact.all_time, exact.all_time)
+
+    def test_merge(self):
+        first = LogAnalyzer(iter([('/a', '0.100'), ('/b', '0.300'), ('/a', '0.201')]), 'compact')
+        second = LogAnalyzer(iter([('/a', '1.500'), ('/c', '0.002')]), 'compact')
+        first.get_data()
+        second.get_data()
+        first.merge_state(second.dump_state())
+        expected = LogAnalyzer(iter([('/a', '0.100'), ('/b', '0.300'), ('/a', '0.201'), ('/a', '1.500'),
+                                     ('/c', '0.002')]))
+        self.assertEqual(list(first.calc()), list(expected.calc()))
+
+
+class ParallelAnalyzerTest(unittest.TestCase):
+
+    log = './test/nginx-access-ui.log-20170630.log'
+
+    @cases([1, 2, 7, 50])
+    def test_split_log(self, parts):
+        ranges = split_log(self.log, parts)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.log))
+        with open(self.log, 'rb') as log:
+            for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(end, next_start)
+                log.seek(end - 1)
+                self.assertEqual(log.read(1), b'\n')
+
+    @cases(['exact', 'compact', 'sketch'])
+    def test_same_as_serial(self, aggregation):
+        serial = LogAnalyzer(log_generator(self.log, LogFormatParser()), aggregation)
+        parallel = parallel_analyzer(self.log, 3, aggregation=aggregation)
+        self.assertEqual(list(parallel.calc()), list(serial.calc()))
+        self.assertEqual(parallel.all_ms, serial.all_ms)
+
+    @cases(['exact', 'compact', 'sketch'])
+    def test_packed_state(self, aggregation):
+        analyzer = LogAnalyzer(log_generator(self.log, LogFormatParser()), aggregation)
+        analyzer.get_data()
+        state = pickle.loads(pickle.dumps(analyzer.pack_state(), pickle.HIGHEST_PROTOCOL))
+        merged = LogAnalyzer(iter(()), aggregation)
+        merged.merge_state(state)
+        self.assertEqual(merged.dump_state(), analyzer.dump_state())
+        self.assertEqual(list(merged.calc()), list(analyzer.calc()))
+
+
+class GzipReaderTest(TmpDirTestCase):
+
+    log = './test/nginx-access-ui.log-20170630.log'
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.gz_log = os.path.join(self.tmp, 'nginx-access-ui.log-20170630.gz')
+        with open(self.log, 'rb') as log:
+            data = log.read()
+        self.lines = data.splitlines(True)
+        middle = len(data) // 2
+        # two gzip members in one file
+        for part in (data[:middle], data[middle:]):
+            with gzip.open(os.path.join(self.tmp, 'part.gz'), 'wb') as part_file:
+                part_file.write(part)
+            with open(os.path.join(self.tmp, 'part.gz'), 'rb') as part_file, open(self.gz_log, 'ab') as gz_log:
+                shutil.copyfileobj(part_file, gz_log)
+
+    @cases(['zlib', 'auto'])
+    def test_lines(self, method):
+        lines = [line.encode('utf-8') if not isinstance(line, bytes) else line
+                 for line in read_gzip(self.gz_log, method, block_size=997, queue_size=2)]
+        self.assertEqual(lines, self.lines)
+
+    def test_same_as_plain(self):
+        plain = LogAnalyzer(log_generator(self.log, LogFormatParser()))
+        packed = LogAnalyzer(log_generator(self.gz_log, LogFormatParser()))
+        self.assertEqual(list(packed.calc()), list(plain.calc()))
+
+    @cases(['zlib', 'auto'])
+    def test_close(self, method):
+        reader = read_gzip(self.gz_log, method, block_size=100, queue_size=1)
+        next(reader)
+        reader.close()
+
+    @cases(['zlib', 'auto'])
+    def test_timing(self, method):
+        stats = {}
+        list(read_gzip(self.gz_log, method, stats=stats))
+        self.assertGreater(stats['decompress_wall'], 0)
+        self.assertGreaterEqual(stats['decompress_child_cpu'], 0)
+        self.assertIn('decompress_cpu', stats)
+
+    @cases([('zlib', 997), ('zlib', 1 << 20), ('auto', 997)])
+    def test_zero_padding(self, args):
+        with open(self.gz_log, 'ab') as gz_log:
+            gz_log.write(b'\x00' * 5000)
+        lines = [line.encode('utf-8') if not isinstance(line, bytes) else line
+                 for line in read_gzip(self.gz_log, args[0], block_size=args[1])]
+        self.assertEqual(lines, self.lines)
+
+    def test_broken(self):
+        with open(self.gz_log, 'r+b') as gz_log:
+            gz_log.truncate(1000)
+        self.assertRaises(Exception, list, read_gzip(self.gz_log, 'zlib'))
+
+
+class UrlNormalizerTest(unittest.TestCase):
+
+    @cases([({}, '/api/v2/internal/banner/24295823/info', '/api/v2/internal/banner/{id}/info'),
+            ({}, '/api/1/campaigns/?id=7391355', '/api/{id}/campaigns/?id=7391355'),
+            ({'query': 'strip'}, '/api/1/campaigns/?id=7391355', '/api/{id}/campaigns/'),
+            ({'query': 'template'}, '/api/v2/group/1/statistic/sites/?date_type=day&date_from=2017-06-29&flag',
+             '/api/v2/group/{id}/statistic/sites/?date_type={}&date_from={}&flag'),
+            ({'ids': False, 'query': 'strip'}, '/api/v2/banner/24824230?x=1', '/api/v2/banner/24824230'),
+            ({}, '/file/550e8400-e29b-41d4-a716-446655440000/x', '/file/{uuid}/x'),
+            ({}, '/request/89f7f1be37d/', '/request/{hex}/'),
+            ({}, '/export/appinstall_raw/2017-06-30/', '/export/appinstall_raw/2017-06-30/'),
+            ({'rules': [[r'^/export/appinstall_raw/[^/]+/', '/export/appinstall_raw/{date}/']]},
+             '/export/appinstall_raw/2017-06-30/', '/export/appinstall_raw/{date}/')])
+    def test_normalize(self, args):
+        settings, url, expected = args
+        self.assertEqual(UrlNormalizer(**settings)(url), expected)
+
+    def test_cache_bounded(self):
+        normalizer = UrlNormalizer(cache_size=10)
+        for i in range(100):
+            self.assertEqual(normalizer('/api/v2/banner/{}'.format(i)), '/api/v2/banner/{id}')
+            self.assertLessEqual(len(normalizer.cache) + len(normalizer.old_cache), 10)
+        self.assertIn('/api/v2/banner/99', normalizer.cache)
+
+    @cases([(None, None), (False, None), ({}, None)])
+    def test_raw_mode(self, args):
+        self.assertEqual(UrlNormalizer.from_config(args[0]), args[1])
+
+    def test_analyzer_keys(self):
+        log = './test/nginx-access-ui.log-20170630.log'
+        raw = LogAnalyzer(log_generator(log, LogFormatParser()))
+        raw.get_data()
+        normalized = LogAnalyzer(normalize_urls(log_generator(log, LogFormatParser()),
+                                                UrlNormalizer(query='strip')))
+        normalized.get_data()
+        self.assertLess(len(normalized.time_sum_buf), len(raw.time_sum_buf) // 2)
+        self.assertEqual(normalized.all_count, raw.all_count)
+        self.assertIn('/api/v2/banner/{id}', normalized.time_sum_buf)
+
+
+class CheckpointTest(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.settings = {'TS_FILE': os.path.join(self.tmp, 'log_analyzer.ts'), 'LOG_DIR': self.tmp,
+                         'REPORT_DIR': os.path.join(self.tmp, 'reports'), 'REPORT_TEMPLATE': './report.html'}
+        log_analyzer.config.update(self.settings)
+        self.checkpoint = os.path.join(self.tmp, 'log_analyzer.checkpoint')
+        self.log = os.path.join(self.tmp, 'nginx-access-ui.log-20170630.log')
+        with open('./test/nginx-access-ui.log-20170630.log', 'rb') as log:
+            self.lines = [line.rstrip(b'\n') + b'\n' for line in log]
+        self.write(self.lines[:200], 'wb')
+
+    def write(self, lines, mode='ab', path=None):
+        with open(path or self.log, mode) as log:
+            log.writelines(lines)
+
+    def analyze(self, analyzer=None, start=0):
+        analyzer = analyzer or LogAnalyzer(iter(()))
+        stats = {}
+        analyze_log(analyzer, self.log, start, stats)
+        save_checkpoint(self.checkpoint, self.log, analyzer, stats['offset'], stats['lines'], True)
+        return analyzer
+
+    def test_resume(self):
+        self.analyze()
+        checkpoint = load_checkpoint(self.checkpoint, self.log)
+        self.assertFalse(checkpoint_behind(checkpoint, self.log))
+        self.write(self.lines[200:])
+        checkpoint = load_checkpoint(self.checkpoint, self.log)
+        self.assertTrue(checkpoint_behind(checkpoint, self.log))
+        resumed = LogAnalyzer(iter(()))
+        resumed.merge_state(checkpoint['state'])
+        self.analyze(resumed, checkpoint['offset'])
+        full = LogAnalyzer(log_generator(self.log, LogFormatParser()))
+        self.assertEqual(resumed.top(1000), full.top(1000))
+
+    def test_unterminated_line(self):
+        self.check_unterminated_line(1)
+
+    def test_unterminated_line_parallel(self):
+        self.check_unterminated_line(2)
+
+    def check_unterminated_line(self, workers):
+        self.write(self.lines[:1] + [self.lines[1][:50]], 'wb')
+        self.run_main(CHECKPOINT=True, WORKERS=workers, **self.settings)
+        checkpoint = load_checkpoint(self.checkpoint, self.log)
+        self.assertEqual((checkpoint['offset'], checkpoint['state']['all_count']), (len(self.lines[0]), 1))
+        self.assertTrue(checkpoint_behind(checkpoint, self.log))
+        self.write([self.lines[1][50:]])
+        self.run_main(CHECKPOINT=True, WORKERS=workers, **self.settings)
+        checkpoint = load_checkpoint(self.checkpoint, self.log)
+        self.assertEqual(checkpoint['state']['all_count'], 2)
+        self.assertFalse(checkpoint_behind(checkpoint, self.log))
+
+    def test_last_line_end(self):
+        self.write([b'x' * 100], 'wb')
+        self.assertEqual(log_analyzer.last_line_end(self.log, block_size=16), 0)
+        self.write(self.lines[:3] + [b'x' * 100], 'wb')
+        self.assertEqual(log_analyzer.last_line_end(self.log, block_size=16), len(b''.join(self.lines[:3])))
+
+    def test_rename(self):
+        self.analyze()
+        rotated = self.log + '.1'
+        os.rename(self.log, rotated)
+        self.assertIsNotNone(load_checkpoint(self.checkpoint, rotated))
+
+    def test_replaced(self):
+        self.analyze()
+        self.write(self.lines[:200], 'wb', self.log + '.new')
+        os.rename(self.log + '.new', self.log)
+        self.assertIsNone(load_checkpoint(self.checkpoint, self.log))
+
+    def test_truncated(self):
+        self.analyze()
+        self.write(self.lines[:100], 'wb')
+        self.assertIsNone(load_checkpoint(self.checkpoint, self.log))
+
+    def test_settings_changed(self):
+        self.analyze()
+        log_analyzer.config['AGGREGATION'] = 'sketch'
+        self.assertIsNone(load_checkpoint(self.checkpoint, self.log))
+
+    def test_header_only(self):
+        self.analyze()
+        checkpoint = load_checkpoint(self.checkpoint, self.log, state=False)
+        self.assertNotIn('state', checkpoint)
+        self.assertFalse(checkpoint_behind(checkpoint, self.log))
+
+    def test_disabled_by_default(self):
+        self.run_main(**self.settings)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'reports', 'report-2017.06.30.html')))
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_progress(self):
+        offsets = []
+        items = log_generator(self.log, LogFormatParser(), progress_every=50,
+                              on_progress=lambda stats: offsets.append((stats['lines'], stats['offset'])))
+        list(items)
+        self.assertEqual(offsets, [(n, len(b''.join(self.lines[:n]))) for n in (50, 100, 150)])
+
+    def test_timed_items(self):
+        items = [('/a', '0.1'), None, ('/b', '0.2')] * 50
+        stats = {}
+        self.assertEqual(list(log_analyzer.timed_items(iter(items), stats, every=7)), items)
+        self.assertEqual(sorted(stats), ['aggregate_wall', 'parse_wall'])
+
+    def test_main(self):
+        report_path = os.path.join(self.tmp, 'reports', 'report-2017.06.30.html')
+        late_url = '/agency/campaigns/5370444/banners/bulk_read/'
+        self.run_main(CHECKPOINT=True, **self.settings)
+        with open(report_path) as report:
+            first = report.read()
+        self.assertIn('/api/v2/banner/24824230', first)
+        self.assertNotIn(late_url, first)
+        os.remove(report_path)
+        self.run_main(CHECKPOINT=True, **self.settings)
+        with open(report_path) as report:
+            self.assertEqual(report.read(), first)
+        self.write(self.lines[200:])
+        self.run_main(CHECKPOINT=True, **self.settings)
+        with open(report_path) as report:
+            self.assertIn(late_url, report.read())
+        with open(os.path.join(self.tmp, 'log_analyzer.metrics.json')) as metrics_file:
+            metrics = json.load(metrics_file)
+        self.assertEqual(metrics['start_offset'], len(b''.join(self.lines[:200])))
+        self.assertEqual(metrics['report'], report_path)
+        self.assertEqual(sorted(metrics['phases']), ['analyze', 'report', 'store_aggregate', 'top'])
+        analyze = metrics['phases']['analyze']
+        self.assertEqual((analyze['lines'], analyze['errors']), (len(self.lines) - 200, 0))
+        self.assertEqual(analyze['bytes'], len(b''.join(self.lines[200:])))
+        self.assertGreater(analyze['parse_wall'], 0)
+        self.assertIn('aggregate_wall', analyze)
+
+
+class BackfillTest(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.reports = os.path.join(self.tmp, 'reports')
+        os.makedirs(self.reports)
+        source = './test/nginx-access-ui.log-20170630.log'
+        shutil.copy(source, os.path.join(self.tmp, 'nginx-access-ui.log-20170628.log'))
+        gz_path = os.path.join(self.tmp, 'nginx-access-ui.log-20170629.gz')
+        with open(source, 'rb') as log, gzip.open(gz_path, 'wb') as gz:
+            shutil.copyfileobj(log, gz)
+        shutil.copy(source, os.path.join(self.tmp, 'nginx-access-ui.log-20170630.log'))
+        for name in ('nginx-access-api.log-20170627.log', 'nginx-access-ui.log-20171399.log',
+                     os.path.join('reports', 'report-2017.06.30.html')):
+            open(os.path.join(self.tmp, name), 'w').close()
+        self.settings = {'LOG_DIR': self.tmp, 'REPORT_DIR': self.reports, 'REPORT_TEMPLATE': './report.html',
+                         'TS_FILE': os.path.join(self.tmp, 'log_analyzer.ts'), 'BACKFILL_WORKERS': 2}
+
+    def test_scan_logs(self):
+        names = sorted(os.path.basename(log.path) for log in scan_logs(self.tmp))
+        self.assertEqual(names, ['nginx-access-ui.log-20170628.log', 'nginx-access-ui.log-20170629.gz',
+                                 'nginx-access-ui.log-20170630.log'])
+
+    def test_backfill(self):
+        self.run_main('--backfill', **self.settings)
+        self.assertEqual(sorted(os.listdir(self.reports)),
+                         ['report-2017.06.28.html', 'report-2017.06.29.html', 'report-2017.06.30.html'])
+        self.assertEqual(os.path.getsize(os.path.join(self.reports, 'report-2017.06.30.html')), 0)
+        with open(os.path.join(self.reports, 'report-2017.06.28.html')) as first, \
+                open(os.path.join(self.reports, 'report-2017.06.29.html')) as second:
+            self.assertEqual(first.read(), second.read())
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'log_analyzer.ts')))
+
+
+class AggregateStoreTest(TmpDirTestCase):
+
+    log = './test/nginx-access-ui.log-20170630.log'
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        log_analyzer.config.update(AGGREGATE_DIR=os.path.join(self.tmp, 'aggregates'), REPORT_TEMPLATE='./report.html',
+                                   REPORT_DIR=os.path.join(self.tmp, 'reports'))
+
+    @cases(['exact', 'compact', 'sketch'])
+    def test_sketch_state(self, aggregation):
+        analyzer = LogAnalyzer(log_generator(self.log, LogFormatParser()), aggregation)
+        analyzer.get_data()
+        sketch = LogAnalyzer(log_generator(self.log, LogFormatParser()), 'sketch')
+        sketch.get_data()
+        self.assertEqual(analyzer.dump_state(sketch=True), sketch.dump_state())
+
+    def test_rollup(self):
+        analyzer = LogAnalyzer(log_generator(self.log, LogFormatParser()))
+        analyzer.get_data()
+        for day in (28, 29, 30, 31):
+            date = datetime(2017, 5 if day == 31 else 6, day)
+            path = os.path.join(self.tmp, 'aggregates', 'aggregate-{:%Y.%m.%d}.json.gz'.format(date))
+            save_aggregate(path, analyzer, date)
+        self.assertEqual(load_aggregate(path)['state'], analyzer.dump_state(sketch=True))
+        report_path = rollup(datetime(2017, 6, 1), datetime(2017, 6, 29))
+        self.assertTrue(report_path.endswith('report-2017.06.01-2017.06.29.html'))
+        twice = LogAnalyzer(iter(()), 'sketch')
+        for _ in range(2):
+            twice.merge_state(analyzer.dump_state(sketch=True))
+        with open(report_path) as report:
+            self.assertIn(json.dumps(twice.top(1000)), report.read())
+        self.assertIsNone(rollup(datetime(2017, 7, 1), datetime(2017, 7, 31)))
+
+    def test_rollup_without_aggregates(self):
+        self.assertIsNone(rollup(datetime(2017, 6, 1), datetime(2017, 6, 29)))
+        del log_analyzer.config['AGGREGATE_DIR']
+        self.run_main('--rollup', '20170601', '20170629', REPORT_DIR=os.path.join(self.tmp, 'reports'))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'reports')))
+
+
+class MergePartialsTest(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        log_analyzer.config.update(REPORT_TEMPLATE='./report.html', REPORT_DIR=os.path.join(self.tmp, 'reports'))
+        with open('./test/nginx-access-ui.log-20170630.log', 'rb') as log:
+            lines = log.readlines()
+        self.logs = []
+        for host, part in (('first', lines[:150]), ('second', lines[150:])):
+            path = os.path.join(self.tmp, host, 'nginx-access-ui.log-20170630.log')
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as log:
+                log.writelines(part)
+            self.logs.append(log_analyzer.LogFile(path, datetime(2017, 6, 30)))
+
+    @cases(['exact', 'compact', 'sketch'])
+    def test_same_as_concatenated(self, aggregation):
+        log_analyzer.config['AGGREGATION'] = aggregation
+        partials = [os.path.join(self.tmp, '{}.json.gz'.format(i)) for i in range(len(self.logs))]
+        for path, log in zip(partials, self.logs):
+            emit_partial(path, log)
+        report_path = merge_partials(partials)
+        self.assertTrue(report_path.endswith('report-2017.06.30.html'))
+        with open(report_path, 'rb') as report:
+            merged = report.read()
+        whole = LogAnalyzer(log_generator('./test/nginx-access-ui.log-20170630.log', LogFormatParser()), aggregation)
+        log_analyzer.report(whole.top(1000), report_path)
+        with open(report_path, 'rb') as report:
+            self.assertEqual(merged, report.read())
+
+    def test_mixed_aggregations(self):
+        partials = [os.path.join(self.tmp, 'exact.json.gz'), os.path.join(self.tmp, 'sketch.json.gz')]
+        emit_partial(partials[0], self.logs[0])
+        log_analyzer.config['AGGREGATION'] = 'sketch'
+        emit_partial(partials[1], self.logs[1])
+        self.assertRaises(ValueError, merge_partials, partials)
+
+
+class ReportTest(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        log_analyzer.config['REPORT_TEMPLATE'] = './report.html'
+        self.path = os.path.join(self.tmp, 'reports', 'report-2017.06.30.html')
+        analyzer = LogAnalyzer(log_generator('./test/nginx-access-ui.log-20170630.log', LogFormatParser()))
+        self.data = analyzer.top(1000)
+
+    @cases([0, 1, 1000])
+    def test_same_as_replace(self, size):
+        self.assertTrue(log_analyzer.report(self.data[:size], self.path))
+        with open('./report.html') as template, open(self.path) as report:
+            expected = template.read().replace('$table_json', json.dumps(self.data[:size]))
+            self.assertEqual(report.read(), expected.replace('$table_pages', 'null').replace('$table_series', 'null'))
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['report-2017.06.30.html'])
+
+    def test_failure_leaves_no_report(self):
+        def rows():
+            for row in self.data[:2]:
+                yield row
+            raise IOError('disk full')
+
+        self.assertFalse(log_analyzer.report(rows(), self.path))
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+    def test_pages(self):
+        self.assertTrue(log_analyzer.report(self.data, self.path, page_size=100))
+        with open(self.path) as report:
+            content = report.read()
+        self.assertIn('var table = {};'.format(json.dumps(self.data[:100])), content)
+        self.assertIn('var tablePages = {};'.format(json.dumps({'base': 'report-2017.06.30.data/', 'count': 3})),
+                      content)
+        rows = []
+        for page in (1, 2):
+            with open(os.path.join(self.tmp, 'reports', 'report-2017.06.30.data', 'page-{}.js'.format(page))) as f:
+                prefix = 'reportPage({}, '.format(page)
+                content = f.read()
+                self.assertTrue(content.startswith(prefix))
+                rows.extend(json.loads(content[len(prefix):-len(');\n')]))
+        self.assertEqual(rows, self.data[100:])
+
+    def test_missing_placeholder(self):
+        template = os.path.join(self.tmp, 'template.html')
+        with open(template, 'w') as template_file:
+            template_file.write('<html></html>')
+        log_analyzer.config['REPORT_TEMPLATE'] = template
+        self.assertFalse(log_analyzer.report(self.data, self.path))
+
+
+class BenchmarkTest(TmpDirTestCase):
+
+    @cases(['bench.log', 'bench.log.gz'])
+    def test_generate_log(self, name):
+        path = os.path.join(self.tmp, name)
+        stats = {}
+        self.assertEqual(benchmark.generate_log(path, 2000, urls=50, seed=7, malformed=0.1)[0], 2000)
+        analyzer = LogAnalyzer(log_generator(path, LogFormatParser(), error_threshold=None, stats=stats))
+        analyzer.get_data()
+        self.assertEqual(stats['lines'], 2000)
+        self.assertTrue(150 < stats['errors'] < 250)
+        self.assertLessEqual(len(analyzer.urls), 50)
+
+        content = list(read_log(path))
+        benchmark.generate_log(path, 2000, urls=50, seed=7, malformed=0.1)
+        self.assertEqual(list(read_log(path)), content)
+
+    def test_size(self):
+        path = os.path.join(self.tmp, 'bench.log')
+        lines, size = benchmark.generate_log(path, urls=10, size=10000)
+        self.assertEqual(size, os.path.getsize(path))
+        self.assertTrue(10000 <= size < 11000)
+
+
+class SampleTest(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.log = os.path.join(self.tmp, 'nginx-access-ui.log-20170630.log')
+        benchmark.generate_log(self.log, 20000, urls=20, seed=3, malformed=0.01)
+        with gzip.open(self.log + '.gz', 'wb') as gz, open(self.log, 'rb') as log:
+            shutil.copyfileobj(log, gz)
+        self.exact = dict((row['url'], row) for row in LogAnalyzer(
+            log_generator(self.log, LogFormatParser(), error_threshold=None)).top(1000))
+
+    @cases([0, -0.5, 2])
+    def test_bad_rate(self, rate):
+        self.assertRaises(ValueError, list, sample_blocks(self.log, rate))
+        self.assertRaises(log_analyzer.argparse.ArgumentTypeError, log_analyzer.sample_rate, str(rate))
+
+    @cases(['', '.gz'])
+    def test_blocks_cover_log(self, ext):
+        stats = {}
+        lines = [line for block in sample_blocks(self.log + ext, 1.0, block_size=1 << 12, stats=stats)
+                 for line in block]
+        self.assertEqual(sorted(lines), sorted(read_log(self.log)))
+        self.assertGreater(stats['blocks'], 1)
+
+    @cases(['', '.gz'])
+    def test_full_sample_is_exact(self, ext):
+        analyzer = sample_log(self.log + ext, 1.0, block_size=1 << 12)
+        for row in analyzer.top(1000):
+            expected = self.exact[row['url']]
+            self.assertEqual(row['count'], expected['count'])
+            self.assertAlmostEqual(row['time_sum'], expected['time_sum'])
+            self.assertEqual(row['time_med'], expected['time_med'])
+            self.assertEqual((row['count_ci'], row['time_sum_ci']), (0, 0))
+
+    @cases(['', '.gz'])
+    def test_estimates(self, ext):
+        analyzer = sample_log(self.log + ext, 0.3, seed=1, block_size=1 << 12)
+        self.assertLess(analyzer.blocks, analyzer.total_blocks)
+        for row in analyzer.top(3):
+            expected = self.exact[row['url']]
+            self.assertLess(abs(row['count'] - expected['count']), row['count_ci'] * 2)
+            self.assertLess(abs(row['time_sum'] - expected['time_sum']), row['time_sum_ci'] * 2)
+            self.assertTrue(row['time_med_low'] <= expected['time_med'] <= row['time_med_high'])
+
+
+class SpillTest(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.log = os.path.join(self.tmp, 'bench.log')
+        benchmark.generate_log(self.log, 30000, urls=3000, seed=5, zipf=0.8)
+
+    def analyzers(self, aggregation, **limits):
+        expected = LogAnalyzer(log_generator(self.log, LogFormatParser()), aggregation)
+        spilling = SpillingAnalyzer(log_generator(self.log, LogFormatParser()), aggregation,
+                                    partitions=4, spill_dir=self.tmp, **limits)
+        return expected, spilling
+
+    @cases([('exact', {'max_keys': 500}), ('compact', {'max_keys': 500}), ('sketch', {'max_keys': 500}),
+            ('exact', {'max_bytes': 100000})])
+    def test_same_report(self, args):
+        expected, spilling = self.analyzers(args[0], **args[1])
+        rows = spilling.top(100)
+        self.assertTrue(spilling.tmp)
+        self.assertEqual(rows, expected.top(100))
+        self.assertEqual(spilling.all_time, expected.all_time)
+        self.assertEqual(sorted(spilling.calc(), key=lambda row: row['url']),
+                         sorted(expected.calc(), key=lambda row: row['url']))
+        self.assertEqual(spilling.dump_state(), expected.dump_state())
+        tmp = spilling.tmp
+        spilling.close()
+        self.assertFalse(os.path.exists(tmp))
+
+    def test_ties(self):
+        log = './test/nginx-access-ui.log-20170630.log'
+        expected = LogAnalyzer(log_generator(log, LogFormatParser()))
+        spilling = SpillingAnalyzer(iter(()), max_keys=5, spill_dir=self.tmp)
+        expected.get_data()
+        for begin, end in split_log(log, 10):
+            spilling.logiterator = log_generator(log, LogFormatParser(), start=begin, end=end)
+            spilling.get_data()
+            spilling.check_memory()
+        self.assertTrue(spilling.tmp)
+        for size in range(1, len(expected.urls) + 2):
+            self.assertEqual(spilling.top(size), expected.top(size))
+        spilling.close()
+
+    def test_calc_only(self):
+        expected, spilling = self.analyzers('exact', max_keys=500)
+        rows = sorted(spilling.calc(), key=lambda row: row['url'])
+        self.assertTrue(spilling.tmp)
+        self.assertEqual(rows, sorted(expected.calc(), key=lambda row: row['url']))
+        spilling.close()
+
+    def test_save_aggregate(self):
+        expected, spilling = self.analyzers('compact', max_keys=500)
+        expected.get_data()
+        spilling.get_data()
+        self.assertTrue(spilling.tmp)
+        path = os.path.join(self.tmp, 'aggregate.json.gz')
+        save_aggregate(path, spilling, datetime(2017, 6, 30), sketch=False)
+        state = load_aggregate(path)['state']
+        self.assertEqual(sorted(state['urls']), sorted(expected.dump_state()['urls']))
+        self.assertEqual(state['all_count'], expected.all_count)
+        spilling.close()
+
+    def test_no_spill(self):
+        expected, spilling = self.analyzers('exact', max_keys=10 ** 6)
+        self.assertEqual(spilling.top(100), expected.top(100))
+        self.assertIsNone(spilling.tmp)
+
+    def test_merge_state(self):
+        expected, spilling = self.analyzers('compact', max_keys=500)
+        expected.get_data()
+        spilling.logiterator = iter(())
+        for begin, end in split_log(self.log, 4):
+            partial = LogAnalyzer(log_generator(self.log, LogFormatParser(), start=begin, end=end), 'compact')
+            partial.get_data()
+            spilling.merge_state(partial.dump_state())
+        self.assertTrue(spilling.tmp)
+        self.assertEqual(spilling.top(100), expected.top(100))
+        spilling.close()
+
+
+class TimeSeriesTest(TmpDirTestCase):
+
+    log = './test/nginx-access-ui.log-20170630.log'
+
+    def counts(self, series):
+        return dict((url, (entry[2], sum(cell[0] for cell in entry[1].values())))
+                    for url, entry in series.urls.items())
+
+    def test_buckets(self):
+        series = TimeSeries('minute')
+        series.add('/a', '29/Jun/2017:03:50:22 +0300', 0.1)
+        series.add('/a', '29/Jun/2017:03:50:59 +0300', 0.3)
+        series.add('/a', '29/Jun/2017:03:51:00 +0300', 20.0)
+        exported = series.export(['/a', '/b'])
+        self.assertEqual(list(exported['series']), ['/a'])
+        self.assertEqual(exported['series']['/a'], {'resolution': 'minute', 'points': [
+            ['2017-06-29 03:50', 2, 0.4, [0, 0, 0, 1, 0, 1, 0, 0, 0, 0, 0]],
+            ['2017-06-29 03:51', 1, 20.0, [0] * 10 + [1]]]})
+        self.assertEqual(TimeSeries.label('29/Jun/2017:03'), '2017-06-29 03:00')
+        self.assertEqual(TimeSeries.label('29/Jun/2017'), '2017-06-29')
+
+    def test_fold(self):
+        series = TimeSeries('minute', budget=20)
+        for minute in range(60):
+            series.add('/busy', '29/Jun/2017:03:{:02d}:00 +0300'.format(minute), 0.1)
+        for i in range(30):
+            series.add('/rare/{}'.format(i), '29/Jun/2017:{:02d}:{:02d}:00 +0300'.format(i % 24, i), 0.2)
+        self.assertLessEqual(series.cells, 20)
+        self.assertEqual(sum(len(entry[1]) for entry in series.urls.values()), series.cells)
+        self.assertTrue(series.full)
+        self.assertIn('/busy', series.urls)
+        self.assertLess(len(series.urls), 31)
+        self.assertEqual(sum(entry[2] for entry in series.urls.values()), 90)
+        self.assertEqual(sum(cell[0] for entry in series.urls.values() for cell in entry[1].values()), 90)
+        series.add('/rare/0', '29/Jun/2017:04:00:00 +0300', 0.2)
+        series.add('/new', '29/Jun/2017:04:00:00 +0300', 0.2)
+        self.assertNotIn('/new', series.urls)
+        self.assertEqual(sum(entry[2] for entry in series.urls.values()), 92)
+
+    def test_many_urls(self):
+        series = TimeSeries('minute', budget=200)
+        for i in range(5000):
+            series.add('/u/{}'.format(i), '29/Jun/2017:03:{:02d}:00 +0300'.format(i % 60), 0.1)
+        self.assertLessEqual(series.cells, 200)
+        self.assertLessEqual(len(series.urls), 201)
+        self.assertEqual(sum(entry[2] for entry in series.urls.values()), 5000)
+        loaded = TimeSeries.load(series.dump())
+        self.assertEqual(loaded.urls, series.urls)
+        self.assertTrue(loaded.full)
+        merged = TimeSeries('minute', budget=200)
+        merged.merge(loaded)
+        merged.merge(series)
+        self.assertLessEqual(len(merged.urls), 201)
+        self.assertEqual(sum(entry[2] for entry in merged.urls.values()), 10000)
+
+    def test_parallel_same_as_serial(self):
+        serial = LogAnalyzer(iter(()))
+        serial.series = TimeSeries('hour')
+        analyze_log(serial, self.log, workers=1)
+        parallel = LogAnalyzer(iter(()))
+        parallel.series = TimeSeries('hour')
+        parallel_analyzer(self.log, 3, analyzer=parallel)
+        self.assertEqual(self.counts(parallel.series), self.counts(serial.series))
+        self.assertEqual(sum(entry[2] for entry in serial.series.urls.values()), serial.all_count)
+        self.assertEqual(parallel.top(10), serial.top(10))
+
+    def test_report(self):
+        log_analyzer.config.update(REPORT_TEMPLATE='./report.html', TIME_SERIES='minute', SERIES_BUDGET=1000)
+        analyzer = log_analyzer.make_analyzer('exact')
+        analyze_log(analyzer, self.log)
+        data = analyzer.top(10)
+        path = os.path.join(self.tmp, 'report-2017.06.30.html')
+        self.assertTrue(log_analyzer.report(data, path, series=log_analyzer.report_series(analyzer, data)))
+        with open(os.path.join(self.tmp, 'report-2017.06.30.series.json')) as series_file:
+            series = json.load(series_file)
+        self.assertEqual(sum(point[1] for point in series['series'][data[0]['url']]['points']), data[0]['count'])
+        with open(path) as report:
+            self.assertIn('var tableSeries = "report-2017.06.30.series.js";', report.read())
+        with open(os.path.join(self.tmp, 'report-2017.06.30.series.js')) as script:
+            self.assertTrue(script.read().startswith('reportSeries({'))
+
+
+class FollowTest(TmpDirTestCase):
+
+    log = './test/nginx-access-ui.log-20170630.log'
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.path = os.path.join(self.tmp, 'nginx-access-ui.log')
+        with open(self.log, 'rb') as log:
+            self.lines = [line.rstrip(b'\n') + b'\n' for line in log]
+
+    def write(self, data, mode='ab'):
+        with open(self.path, mode) as log:
+            log.write(data)
+
+    def received(self, batches, count):
+        result = []
+        deadline = time.time() + 5
+        while len(result) < count and time.time() < deadline:
+            try:
+                batch = batches.get(timeout=0.1)
+            except Empty:
+                continue
+            result.extend([batch] if batch is log_analyzer.ROTATED else batch)
+        return result
+
+    @cases(['sketch', 'exact', 'compact'])
+    def test_incremental_top(self, aggregation):
+        parser = LogFormatParser()
+        live = LiveAnalyzer(aggregation)
+        for start in range(0, len(self.lines), 7):
+            live.add(parser(line) for line in log_analyzer.split_lines(b''.join(self.lines[start:start + 7])))
+            live.top(5)
+        full = LogAnalyzer(log_generator(self.log, LogFormatParser()), aggregation)
+        expected = full.top(5)
+        data = live.top(5)
+        self.assertEqual([row['url'] for row in data], [row['url'] for row in expected])
+        for row, expected_row in zip(data, expected):
+            for key in expected_row:
+                if key == 'url':
+                    continue
+                self.assertAlmostEqual(row[key], expected_row[key])
+
+    @cases(['sketch', 'exact'])
+    def test_same_as_batch(self, aggregation):
+        parser = LogFormatParser()
+        full = LogAnalyzer(log_generator(self.log, LogFormatParser()), aggregation)
+        full.get_data()
+        for size in range(1, len(full.urls) + 2):
+            live = LiveAnalyzer(aggregation)
+            for start in range(0, len(self.lines), 50):
+                live.add(parser(line) for line in log_analyzer.split_lines(b''.join(self.lines[start:start + 50])))
+                live.top(size)
+            self.assertEqual(live.top(size), full.top(size))
+
+    def test_default_sketch(self):
+        self.assertEqual(LiveAnalyzer().aggregation, 'sketch')
+
+    def test_top_ties(self):
+        live = LiveAnalyzer()
+        urls = ['/tie/%d' % i for i in range(10)]
+        live.add((url, '1.0') for url in urls)
+        self.assertEqual([row['url'] for row in live.top(3)], urls[:3])
+        for url in reversed(urls):
+            live.add([(url, '0.0')])
+            self.assertEqual([row['url'] for row in live.top(3)], urls[:3])
+
+    def test_tail_rotation(self):
+        self.write(b''.join(self.lines[:3]) + self.lines[3][:10])
+        batches = Queue()
+        stop = threading.Event()
+        reader = threading.Thread(target=log_analyzer._tail_producer, args=(self.path, batches, stop, 0.01))
+        reader.start()
+        try:
+            decode = log_analyzer.split_lines
+            self.assertEqual(self.received(batches, 3), decode(b''.join(self.lines[:3])))
+            self.write(self.lines[3][10:])
+            self.assertEqual(self.received(batches, 1), decode(self.lines[3]))
+            self.write(self.lines[4], 'wb')
+            self.assertEqual(self.received(batches, 2), [log_analyzer.ROTATED] + decode(self.lines[4]))
+            os.rename(self.path, self.path + '-1')
+            self.write(self.lines[5], 'ab')
+            self.assertEqual(self.received(batches, 2), [log_analyzer.ROTATED] + decode(self.lines[5]))
+        finally:
+            stop.set()
+            reader.join()
+
+    def test_follow_report(self):
+        stop = threading.Event()
+        report = os.path.join(self.tmp, 'reports', 'report-live.html')
+        self.write(b''.join(self.lines))
+        log_analyzer.config.update(REPORT_TEMPLATE='./report.html', REPORT_SIZE=5)
+        try:
+            follower = threading.Thread(target=log_analyzer.follow, args=(self.path, report, 0.05, 0.01, stop))
+            follower.start()
+            deadline = time.time() + 5
+            while not os.path.exists(report) and time.time() < deadline:
+                time.sleep(0.05)
+            stop.set()
+            follower.join()
+            with open(report) as report_file:
+                self.assertIn('"count": ', report_file.read())
+        finally:
+            stop.set()